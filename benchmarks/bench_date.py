@@ -0,0 +1,48 @@
+"""
+Benchmark of the DATE header generation.
+
+Replays bursts of Echo traffic (one SSDP reply per device followed by
+GetBinaryState/SetBinaryState SOAP replies) and compares formatting the
+date for every reply with format_timetuple_and_zone against the cached
+value of main.date_header.
+
+Run it from the repository root:
+    python -m benchmarks.bench_date          (CPython)
+    mpremote run benchmarks/bench_date.py    (board, main.py uploaded)
+"""
+from hal import ticks_us, ticks_diff
+import main
+
+DEVICES = 16  # SSDP replies per burst
+SOAP_REQUESTS = 48  # SOAP replies per burst
+BURSTS = 50
+
+
+def legacy_date():
+    return main.format_timetuple_and_zone(main.clock.gmtime(), "GMT").encode()
+
+
+def run(name, date):
+    start = ticks_us()
+    for burst in range(BURSTS):
+        for reply in range(DEVICES + SOAP_REQUESTS):
+            date()
+    elapsed = ticks_diff(ticks_us(), start)
+    replies = BURSTS * (DEVICES + SOAP_REQUESTS)
+    print(
+        "%-10s %6d replies %8d us %7.2f us/reply"
+        % (name, replies, elapsed, elapsed / replies)
+    )
+    return elapsed
+
+
+if main.clock is None:
+    main.clock = time
+
+print(
+    "DATE header: %d bursts of %d SSDP + %d SOAP replies"
+    % (BURSTS, DEVICES, SOAP_REQUESTS)
+)
+legacy = run("formatted", legacy_date)
+cached = run("cached", main.date_header.get)
+print("speedup    %.1fx" % (legacy / max(cached, 1)))
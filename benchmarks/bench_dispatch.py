@@ -0,0 +1,239 @@
+"""
+Benchmark of the request dispatch of main.fauxmo.
+
+Replays requests as captured from an Echo (setup.xml, eventservice.xml,
+GetBinaryState and SetBinaryState on/off) through http_connection and
+compares the former find() chain over the whole request with the
+(method, path, SOAP action) table fauxmo.DISPATCH. For every request it
+reports the substring scans (find() calls on the request, including the
+search for the end of the head), the bytes they examined and the time per
+request, with the replies counted instead of sent.
+
+Run it from the repository root (CPython, the scans are counted by a
+bytes subclass):
+    python -m benchmarks.bench_dispatch
+"""
+from hal import ticks_us, ticks_diff
+import main
+
+ROUNDS = 2000
+
+SOAP_REQUEST = (
+    b"POST /upnp/control/basicevent1 HTTP/1.1\r\n"
+    b"Host: 192.168.1.30:12340\r\n"
+    b"Accept: */*\r\n"
+    b'Content-type: text/xml; charset="utf-8"\r\n'
+    b'SOAPACTION: "urn:Belkin:service:basicevent:1#%s"\r\n'
+    b"Content-Length: %d\r\n"
+    b"\r\n"
+    b"%s"
+)
+SOAP_BODY = (
+    b'<?xml version="1.0" encoding="utf-8"?>'
+    b'<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    b's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+    b'<s:Body><u:%s xmlns:u="urn:Belkin:service:basicevent:1">'
+    b"%s</u:%s></s:Body></s:Envelope>"
+)
+
+
+def soap_request(action, argument=b""):
+    body = SOAP_BODY % (action, argument, action)
+    return SOAP_REQUEST % (action, len(body), body)
+
+
+REQUESTS = (
+    (
+        "setup.xml",
+        b"GET /setup.xml HTTP/1.1\r\n"
+        b"Host: 192.168.1.30:12340\r\n"
+        b"Accept: */*\r\n"
+        b"\r\n",
+    ),
+    (
+        "eventservice.xml",
+        b"GET /eventservice.xml HTTP/1.1\r\n"
+        b"Host: 192.168.1.30:12340\r\n"
+        b"Accept: */*\r\n"
+        b"\r\n",
+    ),
+    ("GetBinaryState", soap_request(b"GetBinaryState")),
+    (
+        "SetBinaryState 1",
+        soap_request(b"SetBinaryState", b"<BinaryState>1</BinaryState>"),
+    ),
+    (
+        "SetBinaryState 0",
+        soap_request(b"SetBinaryState", b"<BinaryState>0</BinaryState>"),
+    ),
+)
+
+scans = 0
+examined = 0
+
+
+class counted_bytes(bytes):
+    # bytes which count the find() calls and the bytes they examined
+    def find(self, sub, start=0, end=None):
+        global scans, examined
+        if end is None:
+            end = len(self)
+        found = bytes.find(self, sub, start, end)
+        scans += 1
+        examined += (end if found == -1 else found + len(sub)) - start
+        return found
+
+
+main_buffer_find = main.buffer_find
+
+
+def counted_buffer_find(buffer, sub, start, end):
+    global scans, examined
+    found = main_buffer_find(buffer, sub, start, end)
+    scans += 1
+    examined += (end if found == -1 else found + len(sub)) - start
+    return found
+
+
+class replay_socket:
+    # hands the captured request to http_connection
+    def __init__(self):
+        self.data = b""
+
+    def recv_into(self, buffer):
+        count = len(self.data)
+        buffer[:count] = self.data
+        return count
+
+
+class replay_device(main.fauxmo):
+    # fauxmo without sockets, the replies are counted instead of sent
+    def __init__(self, name):
+        self.name = name
+        self.serial = self.make_uuid(name)
+        self.relayState = 0
+        self.action_handler = self
+        self.setup_xml = main.SETUP_XML % {
+            "device_name": name,
+            "device_serial": self.serial,
+            "url_base": "",
+        }
+        self.setup_response = main.cached_response(
+            "text/xml", main.XML_HEADERS, self.setup_xml
+        )
+        self.replies = 0
+
+    def on(self):
+        return True
+
+    def off(self):
+        return True
+
+    def save_state(self):
+        pass
+
+    def reply(self, socket, response):
+        self.replies += 1
+
+
+def legacy_handle_request(device, data, socket):
+    # the find() chain fauxmo.handle_request used before the dispatch table
+    if (
+        data.find(b"POST /upnp/control/basicevent1 HTTP/1.1") == 0
+        and data.find(b"urn:Belkin:service:basicevent:1#GetBinaryState") != -1
+    ):
+        date = main.date_header.get()
+        device.reply(
+            socket,
+            main.BINARYSTATE_RESPONSE.render(
+                date, device.getState(), socket.keep_alive
+            ),
+        )
+    elif data.find(b"GET /eventservice.xml HTTP/1.1") == 0:
+        date = main.date_header.get()
+        device.reply(
+            socket, main.EVENTSERVICE_RESPONSE.render(date, None, socket.keep_alive)
+        )
+    elif data.find(b"GET /setup.xml HTTP/1.1") == 0:
+        date = main.date_header.get()
+        device.reply(
+            socket, device.setup_response.render(date, None, socket.keep_alive)
+        )
+    elif (
+        data.find(b'SOAPACTION: "urn:Belkin:service:basicevent:1#SetBinaryState"') != -1
+    ):
+        success = False
+        if data.find(b"<BinaryState>1</BinaryState>") != -1:
+            device.relayState = 1
+            success = main.actuator.submit(device, 1)
+        elif data.find(b"<BinaryState>0</BinaryState>") != -1:
+            device.relayState = 0
+            success = main.actuator.submit(device, 0)
+        if success:
+            date = main.date_header.get()
+            device.reply(
+                socket,
+                main.BINARYSTATE_RESPONSE.render(
+                    date, device.getState(), socket.keep_alive
+                ),
+            )
+
+
+def legacy(device, connection, raw, wrap):
+    # the whole request was copied out of the buffer and scanned
+    connection.next_request()
+    legacy_handle_request(device, wrap(raw), connection)
+
+
+def dispatch(device, connection, raw, wrap):
+    request = connection.next_request()
+    request.body = wrap(request.body)
+    device.handle_request(request, None, connection)
+
+
+def replay(handle, raw, rounds, wrap):
+    device = replay_device("bench")
+    source = replay_socket()
+    source.data = raw
+    connection = main.http_connection(source, None)
+    start = ticks_us()
+    for i in range(rounds):
+        connection.receive()
+        handle(device, connection, raw, wrap)
+    elapsed = ticks_diff(ticks_us(), start)
+    assert device.replies == rounds
+    return elapsed
+
+
+def run():
+    global scans, examined
+    main.DEBUG = False
+    print("%-18s %-9s %6s %9s %9s" % ("request", "", "scans", "bytes", "us/req"))
+    totals = {}
+    for name, raw in REQUESTS:
+        for label, handle in (("find()", legacy), ("dispatch", dispatch)):
+            scans = examined = 0
+            main.buffer_find = counted_buffer_find
+            try:
+                replay(handle, raw, 1, counted_bytes)
+            finally:
+                main.buffer_find = main_buffer_find
+            elapsed = replay(handle, raw, ROUNDS, bytes)
+            total = totals.setdefault(label, [0, 0, 0])
+            total[0] += scans
+            total[1] += examined
+            total[2] += elapsed / ROUNDS
+            print(
+                "%-18s %-9s %6d %9d %9.2f"
+                % (name, label, scans, examined, elapsed / ROUNDS)
+            )
+    count = len(REQUESTS)
+    for label in ("find()", "dispatch"):
+        total = totals[label]
+        print(
+            "%-18s %-9s %6.1f %9.1f %9.2f"
+            % ("mean", label, total[0] / count, total[1] / count, total[2] / count)
+        )
+
+
+run()
@@ -0,0 +1,383 @@
+"""
+Load generator for a running uPyEcho instance.
+
+Replays Echo-style traffic against the board or a hosted instance:
+bursts of M-SEARCH requests (which also discover the devices), then
+GET setup.xml and GetBinaryState/SetBinaryState SOAP requests from
+several keep-alive clients at a given rate. For every kind of request it
+reports p50/p99 latency, throughput and dropped replies (missing SSDP
+replies, HTTP errors and timeouts). The heap of the instance (used, peak
+and, on the board, free) is read from its /metrics before and after the
+HTTP load.
+
+Run it on a workstation (CPython) from the repository root:
+    python -m benchmarks.bench_load                      (multicast discovery)
+    python -m benchmarks.bench_load --ssdp-host 192.168.1.50
+    python -m benchmarks.bench_load --local              (hosted instance)
+
+With --local a hosted instance (main.py) is started in a process of its
+own, so its metrics do not include the load generator.
+"""
+import argparse
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+SSDP_ADDRESS = "239.255.255.250"
+SSDP_PORT = 1900
+M_SEARCH = (
+    b"M-SEARCH * HTTP/1.1\r\n"
+    b"HOST: 239.255.255.250:1900\r\n"
+    b'MAN: "ssdp:discover"\r\n'
+    b"MX: %d\r\n"
+    b"ST: urn:Belkin:device:**\r\n"
+    b"\r\n"
+)
+SOAP_REQUEST = (
+    b"POST %s/upnp/control/basicevent1 HTTP/1.1\r\n"
+    b"HOST: %s:%d\r\n"
+    b'SOAPACTION: "urn:Belkin:service:basicevent:1#%s"\r\n'
+    b'CONTENT-TYPE: text/xml; charset="utf-8"\r\n'
+    b"CONTENT-LENGTH: %d\r\n"
+    b"\r\n"
+    b"%s"
+)
+SOAP_BODY = (
+    b'<?xml version="1.0" encoding="utf-8"?>'
+    b'<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+    b'<s:Body><u:%s xmlns:u="urn:Belkin:service:basicevent:1">'
+    b"%s</u:%s></s:Body></s:Envelope>"
+)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class load_stats:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []  # s
+        self.expected = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def report(self):
+        received = len(self.latencies)
+        dropped = max(self.expected - received, self.errors)
+        print(
+            "%-16s %6d expected %6d replies %5d dropped  p50 %7.2f ms  p99 %7.2f ms"
+            "  %8.1f replies/s"
+            % (
+                self.name,
+                self.expected,
+                received,
+                dropped,
+                percentile(self.latencies, 0.5) * 1000,
+                percentile(self.latencies, 0.99) * 1000,
+                received / max(self.elapsed, 1e-9),
+            )
+        )
+
+
+def header(response, name):
+    start = response.find(b"\r\n" + name + b":")
+    if start == -1:
+        return None
+    start += len(name) + 3
+    end = response.find(b"\r\n", start)
+    return response[start:end].strip()
+
+
+def ssdp_bursts(target, bursts, burst_size, mx):
+    """
+     Sends bursts of M-SEARCH requests, each from a socket of its own (the
+     responder answers a sender only once per search target and window),
+     and collects the replies until the MX window of every burst is over.
+     Returns the stats and the setup.xml URLs found.
+    """
+    stats = load_stats("M-SEARCH")
+    locations = set()
+    start = time.perf_counter()
+    for burst in range(bursts):
+        sockets = []
+        sent = time.perf_counter()
+        for i in range(burst_size):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+            sock.bind(("", 0))
+            sock.sendto(M_SEARCH % mx, target)
+            sockets.append(sock)
+        deadline = sent + mx + 0.5
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            readable = select.select(sockets, [], [], remaining)[0]
+            for sock in readable:
+                data, sender = sock.recvfrom(2048)
+                location = header(data, b"LOCATION")
+                if location:
+                    locations.add(location.decode())
+                    stats.add(time.perf_counter() - sent)
+        for sock in sockets:
+            sock.close()
+    stats.elapsed = time.perf_counter() - start
+    # every device answers every M-SEARCH
+    stats.expected = bursts * burst_size * len(locations)
+    return stats, sorted(locations)
+
+
+def split_location(location):
+    # http://ip:port/prefix/setup.xml -> (ip, port, b"/prefix")
+    address, path = location[len("http://") :].split("/", 1)
+    host, port = address.split(":")
+    prefix = ("/" + path[: -len("setup.xml")]).rstrip("/")
+    return host, int(port), prefix.encode()
+
+
+def build_request(kind, location, index):
+    host, port, prefix = split_location(location)
+    if kind == "setup.xml":
+        request = b"GET %s/setup.xml HTTP/1.1\r\nHOST: %s:%d\r\n\r\n" % (
+            prefix,
+            host.encode(),
+            port,
+        )
+    else:
+        if kind == "SetBinaryState":
+            argument = b"<BinaryState>%d</BinaryState>" % (index % 2)
+        else:
+            argument = b""
+        action = kind.encode()
+        body = SOAP_BODY % (action, argument, action)
+        request = SOAP_REQUEST % (
+            prefix,
+            host.encode(),
+            port,
+            action,
+            len(body),
+            body,
+        )
+    return host, port, request
+
+
+def read_response(sock, pending):
+    # returns (response, rest of the received data)
+    while b"\r\n\r\n" not in pending:
+        data = sock.recv(4096)
+        if not data:
+            raise OSError("connection closed")
+        pending += data
+    end = pending.find(b"\r\n\r\n") + 4
+    length = int(header(pending[:end], b"CONTENT-LENGTH") or 0)
+    while len(pending) < end + length:
+        data = sock.recv(4096)
+        if not data:
+            raise OSError("connection closed")
+        pending += data
+    return pending[: end + length], pending[end + length :]
+
+
+def http_client(kind, locations, count, interval, timeout, stats, offset):
+    """
+     One keep-alive client sending count requests, one every interval
+     seconds (as fast as possible if 0), to the devices in turn.
+    """
+    sock = None
+    pending = b""
+    start = time.perf_counter()
+    for index in range(count):
+        if interval:
+            delay = start + index * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        host, port, request = build_request(
+            kind, locations[(offset + index) % len(locations)], index
+        )
+        sent = time.perf_counter()
+        try:
+            if sock is None:
+                sock = socket.create_connection((host, port), timeout)
+                pending = b""
+            sock.sendall(request)
+            response, pending = read_response(sock, pending)
+            if not response.startswith(b"HTTP/1.1 200"):
+                raise OSError(response.split(b"\r\n", 1)[0])
+            stats.add(time.perf_counter() - sent)
+            if header(response, b"CONNECTION") == b"close":
+                sock.close()
+                sock = None
+        except OSError:
+            stats.error()
+            if sock is not None:
+                sock.close()
+                sock = None
+    if sock is not None:
+        sock.close()
+
+
+def http_load(kind, locations, concurrency, requests, rate, timeout):
+    stats = load_stats(kind)
+    stats.expected = concurrency * requests
+    # rate is the total request rate of all clients
+    interval = concurrency / rate if rate else 0
+    clients = [
+        threading.Thread(
+            target=http_client,
+            args=(kind, locations, requests, interval, timeout, stats, i),
+        )
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+def start_local():
+    # hosted instance in a process of its own
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    instance = subprocess.Popen(
+        [sys.executable, "main.py"],
+        cwd=root,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    time.sleep(1)
+    return instance
+
+
+def read_heap(location, timeout):
+    """
+     Reads the heap gauges (upyecho_heap_*_bytes) from /metrics of the
+     instance serving location. Returns {name: bytes}, empty if the
+     instance has no metrics.
+    """
+    host, port, prefix = split_location(location)
+    heap = {}
+    try:
+        sock = socket.create_connection((host, port), timeout)
+        try:
+            sock.sendall(
+                b"GET /metrics HTTP/1.1\r\nHOST: %s:%d\r\nCONNECTION: close\r\n\r\n"
+                % (host.encode(), port)
+            )
+            response = read_response(sock, b"")[0]
+        finally:
+            sock.close()
+    except OSError:
+        return heap
+    for line in response.split(b"\n"):
+        if line.startswith(b"upyecho_heap_"):
+            name, value = line.split()
+            heap[name[len(b"upyecho_heap_") : -len(b"_bytes")].decode()] = int(
+                float(value)
+            )
+    return heap
+
+
+def report_heap(before, after):
+    if not after:
+        print("heap             not reported by the instance")
+        return
+    for name in ("used", "free", "peak"):
+        if name in after:
+            print(
+                "heap %-11s %9d bytes before %9d bytes after"
+                % (name, before.get(name, 0), after[name])
+            )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--ssdp-host",
+        default=SSDP_ADDRESS,
+        help="address the M-SEARCH requests are sent to (default: multicast)",
+    )
+    parser.add_argument("--bursts", type=int, default=5)
+    parser.add_argument("--burst-size", type=int, default=4)
+    parser.add_argument("--mx", type=int, default=1)
+    parser.add_argument(
+        "--location",
+        action="append",
+        default=[],
+        help="setup.xml URL of a device, skips the discovery (repeatable)",
+    )
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=50, help="per client")
+    parser.add_argument(
+        "--rate", type=float, default=0, help="requests/s (default: unlimited)"
+    )
+    parser.add_argument("--timeout", type=float, default=5)
+    parser.add_argument(
+        "--local", action="store_true", help="start a hosted instance (main.py)"
+    )
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    instance = None
+    if args.local:
+        instance = start_local()
+    try:
+        benchmark(args)
+    finally:
+        if instance is not None:
+            instance.terminate()
+            instance.wait()
+
+
+def benchmark(args):
+    results = []
+
+    stats, locations = ssdp_bursts(
+        (args.ssdp_host, SSDP_PORT), args.bursts, args.burst_size, args.mx
+    )
+    results.append(stats)
+    locations = args.location or locations
+    if not locations:
+        print("no devices found, use --ssdp-host or --location")
+        return
+    print("%d devices, %d clients" % (len(locations), args.concurrency))
+    heap_before = read_heap(locations[0], args.timeout)
+    for kind in ("setup.xml", "GetBinaryState", "SetBinaryState"):
+        results.append(
+            http_load(
+                kind,
+                locations,
+                args.concurrency,
+                args.requests,
+                args.rate,
+                args.timeout,
+            )
+        )
+    heap_after = read_heap(locations[0], args.timeout)
+    for stats in results:
+        stats.report()
+    report_heap(heap_before, heap_after)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark of the readiness dispatch of main.poller.
+
+Registers one UDP socket per device on 127.0.0.1, sends datagrams to them
+round-robin and measures how many read events per second poller.poll
+dispatches to the targets, with debug output disabled.
+
+Run it from the repository root:
+    python -m benchmarks.bench_poller          (CPython)
+    mpremote run benchmarks/bench_poller.py    (board, main.py uploaded)
+
+On the board the number of sockets is limited, device counts which do not
+fit are reported as skipped.
+"""
+from hal import ticks_us, ticks_diff
+import main
+
+EVENTS = 2000
+
+
+class udp_target:
+    def __init__(self):
+        self.socket = main.socket.socket(main.socket.AF_INET, main.socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.address = self.socket.getsockname()
+        self.reads = 0
+
+    def sockets(self):
+        return self.socket
+
+    def do_read(self, socket):
+        socket.recv(64)
+        self.reads += 1
+
+
+def run(devices, use_select=False):
+    p = main.poller()
+    if use_select:
+        p.use_poll = False
+        p.by_fileno = False
+    targets = []
+    try:
+        for i in range(devices):
+            targets.append(udp_target())
+    except OSError:
+        for target in targets:
+            target.socket.close()
+        print("%2d devices: skipped, not enough sockets" % devices)
+        return
+    for target in targets:
+        p.add(target)
+    sender = main.socket.socket(main.socket.AF_INET, main.socket.SOCK_DGRAM)
+
+    elapsed = 0
+    for i in range(EVENTS):
+        sender.sendto(b"x", targets[i % devices].address)
+        start = ticks_us()
+        p.poll(100)
+        elapsed += ticks_diff(ticks_us(), start)
+    handled = sum([target.reads for target in targets])
+
+    sender.close()
+    for target in targets:
+        p.remove(target)
+        target.socket.close()
+    print(
+        "%2d devices: %5d events %8d us %8.0f events/s"
+        % (devices, handled, elapsed, handled * 1000000 / max(elapsed, 1))
+    )
+
+
+main.DEBUG = False
+print("poller.poll dispatch, %d events per run" % EVENTS)
+for devices in (1, 4, 16):
+    run(devices)
+print("select.select fallback")
+for devices in (1, 4, 16):
+    run(devices, use_select=True)
@@ -0,0 +1,177 @@
+"""
+Startup benchmark with WLAN and NTP stand-ins.
+
+Drives startup.wlan_connector and startup.clock_sync with a station which
+only connects after some attempts (and has no route right after it) and
+an NTP sync which fails, checks that the reconnect timeouts double up to
+their maximum and that main.set_clock gets the clock once the sync
+succeeds. Then it starts the hosted instance (thread_echo) with a
+station which connects late and an unreachable NTP server and measures
+the time from the connection to the first setup.xml reply.
+
+Run it from the repository root (CPython):
+    python -m benchmarks.bench_startup
+"""
+import socket
+import threading
+import time
+
+import hal
+from hal import ticks_ms, ticks_diff
+import main
+import startup
+
+CHECK_MS = 5
+main.DEBUG = False
+
+
+class fake_station:
+    """
+     Station interface of network.WLAN. It connects on the connect_on-th
+     call of connect() (0: by itself after connect_ms, like the attempt of
+     boot.py) and its ifconfig() fails route_errors times after that.
+    """
+
+    def __init__(self, connect_on=0, connect_ms=0, route_errors=0):
+        self.connect_on = connect_on
+        self.connect_ms = connect_ms
+        self.route_errors = route_errors
+        self.created = ticks_ms()
+        self.connects = []  # ticks_ms() of the connect() calls
+        self.connected = False
+
+    def isconnected(self):
+        if not self.connect_on and not self.connected:
+            self.connected = ticks_diff(ticks_ms(), self.created) >= self.connect_ms
+        return self.connected
+
+    def active(self, *args):
+        return True
+
+    def connect(self, *args):
+        self.connects.append(ticks_ms())
+        if len(self.connects) == self.connect_on:
+            self.connected = True
+
+    def ifconfig(self):
+        if self.route_errors:
+            self.route_errors -= 1
+            raise OSError(101)  # ENETUNREACH
+        return (hal.local_ip_address(), "255.255.255.0", "0.0.0.0", "0.0.0.0")
+
+
+class fake_ntp:
+    # sync function which fails `failures` times before it returns a clock
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = []
+
+    def __call__(self, server):
+        self.calls.append(ticks_ms())
+        if len(self.calls) <= self.failures:
+            raise OSError(110)  # ETIMEDOUT
+        return time
+
+
+def check_backoff():
+    station = fake_station(connect_on=3, route_errors=2)
+    wlan = startup.wlan_connector(
+        station,
+        "ssid",
+        "password",
+        check_ms=CHECK_MS,
+        timeout_ms=40,
+        max_timeout_ms=120,
+    )
+    timeouts = []
+    attempts = wlan.attempts
+    polls = 0
+    ip_address = wlan.poll()
+    while ip_address is None:
+        if wlan.attempts != attempts:
+            attempts = wlan.attempts
+            timeouts.append(wlan.timeout_ms)
+        time.sleep(CHECK_MS / 1000)
+        polls += 1
+        ip_address = wlan.poll()
+    waits = [
+        ticks_diff(station.connects[i], start)
+        for i, start in enumerate([station.created] + station.connects[:-1])
+    ]
+    print(
+        "WLAN  connected after %d attempts, waits %s ms, timeouts %s ms, "
+        "%d polls, last error %r" % (wlan.attempts, waits, timeouts, polls, wlan.error)
+    )
+    # the attempt of boot.py gets the first timeout, then it doubles
+    assert timeouts == [80, 120, 120], timeouts
+    for wait, timeout in zip(waits, [40] + timeouts):
+        assert wait >= timeout, (wait, timeout)
+    assert isinstance(wlan.error, OSError)
+
+
+def check_clock_sync():
+    sync = fake_ntp(failures=2)
+    main.date_header.second = 0
+    clocks = []
+
+    def on_synced(clock):
+        clocks.append(clock)
+        main.set_clock(clock)
+
+    ntp = startup.clock_sync(sync, main.NTP_SERVER, on_synced, retry_ms=30)
+    main.clock = None
+    while not ntp.done:
+        ntp.step()
+        time.sleep(CHECK_MS / 1000)
+    waits = [ticks_diff(sync.calls[i + 1], sync.calls[i]) for i in range(2)]
+    print(
+        "NTP   synced after %d attempts, waits %s ms, last error %r"
+        % (len(sync.calls), waits, ntp.error)
+    )
+    assert clocks == [time] and main.clock is time
+    # the DATE headers are formatted again with the synced clock
+    assert main.date_header.second is None
+    assert min(waits) >= 30, waits
+
+
+def time_to_first_reply():
+    station = fake_station(connect_ms=300)
+    sync = fake_ntp(failures=1000000)
+    hal.station = lambda: station
+    hal.ntp_clock = sync
+    main.device_states.path = "/tmp/bench_startup_state.json"
+    threading.Thread(target=main.thread_echo, args=("",), daemon=True).start()
+    config = main.device_config(main.CONFIG_FILE)
+    if config.load() and config.devices:
+        name = config.devices[0]["description"]
+    else:
+        name = main.default_devices()[0]["description"]
+    request = b"GET /%s/setup.xml HTTP/1.1\r\nCONNECTION: close\r\n\r\n" % (
+        main.fauxmo.make_uuid(name).encode()
+    )
+    while True:
+        try:
+            client = socket.create_connection(
+                (hal.local_ip_address(), main.SHARED_HTTP_PORT), 1
+            )
+            client.sendall(request)
+            reply = client.recv(256)
+            client.close()
+            if reply.startswith(b"HTTP/1.1 200"):
+                break
+        except OSError:
+            pass
+        time.sleep(CHECK_MS / 1000)
+    connected = station.created + station.connect_ms
+    print(
+        "HTTP  first setup.xml reply %d ms after the WLAN connected, "
+        "NTP unreachable (%d attempts so far)"
+        % (ticks_diff(ticks_ms(), connected), len(sync.calls))
+    )
+    # DATE is taken from the time since boot until the sync succeeds
+    assert b"\r\nDATE: " in reply
+
+
+check_backoff()
+check_clock_sync()
+time_to_first_reply()
@@ -17,25 +17,39 @@
 
 # boot.py -- run on boot-up
 
-# wlan access
+# wlan access, used if config.json has no "wlan" entry
 SSID = ""
 WPA2_PASS = ""
+CONFIG_FILE = "config.json"
 
-ssid_ = SSID
-wpa2_pass = WPA2_PASS
+
+def load_wlan():
+    try:
+        import ujson as json
+    except:
+        import json
+
+    try:
+        with open(CONFIG_FILE) as config:
+            wlan = json.load(config).get("wlan", {})
+    except:
+        wlan = {}
+    return wlan.get("ssid") or SSID, wlan.get("password") or WPA2_PASS
+
+
+ssid_, wpa2_pass = load_wlan()
 
 
 def do_connect():
+    # only starts the connection, main.py waits for it (and retries)
+    # without blocking the LEDs
     import network
 
     sta_if = network.WLAN(network.STA_IF)
-    if not sta_if.isconnected():
+    if not sta_if.isconnected() and ssid_:
         print("connecting to network...")
         sta_if.active(True)
         sta_if.connect(ssid_, wpa2_pass)
-        while not sta_if.isconnected():
-            pass
-    print("network config:", sta_if.ifconfig())
 
 
 do_connect()
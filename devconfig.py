@@ -0,0 +1,81 @@
+"""
+Declarative configuration of uPyEcho.
+
+config.json holds the WLAN credentials and the virtual devices:
+
+    {
+      "wlan": {"ssid": "...", "password": "..."},
+      "devices": [
+        {"description": "white led", "port": 12340,
+         "color": [255, 255, 255], "brightness": 50},
+        {"description": "two tone led", "port": 12345,
+         "group": [{"color": [255, 0, 0], "brightness": 50, "leds": [0, 72]},
+                   {"color": [30, 144, 255], "brightness": 90,
+                    "leds": [72, null]}]}
+      ]
+    }
+
+The strings derived from a device (serial, setup.xml, SSDP reply) are
+stored in a cache file next to it. The cache is only used as long as the
+config file, the version (templates and board) given by main.py, the IP
+address and the port match the ones it was built for.
+"""
+try:
+    import ujson as json
+except:
+    import json
+try:
+    import uos as os
+except:
+    import os
+
+
+class device_config:
+    def __init__(self, path="config.json"):
+        self.path = path
+        self.cache_path = path + ".cache"
+        self.wlan = {}
+        self.devices = None  # None: no config file
+        self.cache = {}
+
+    def load(self):
+        try:
+            with open(self.path) as config:
+                data = json.load(config)
+        except:
+            return False
+        self.wlan = data.get("wlan", {})
+        self.devices = data.get("devices")
+        return True
+
+    def cache_key(self, ip_address, port, version=""):
+        # changes with the config file, the version and the network setup
+        try:
+            stat = os.stat(self.path)
+            signature = "%d:%d" % (stat[6], stat[8])
+        except:
+            signature = "default"
+        return "%s:%s:%s:%s" % (signature, version, ip_address, port)
+
+    def load_cache(self, key):
+        """
+         Loads the precomputed strings of the devices (name -> dict) if they
+         were built for key.
+        """
+        try:
+            with open(self.cache_path) as cache:
+                data = json.load(cache)
+        except:
+            return False
+        if data.get("key") != key:
+            return False
+        self.cache = data.get("devices", {})
+        return True
+
+    def save_cache(self, key, devices):
+        try:
+            with open(self.cache_path, "w") as cache:
+                json.dump({"key": key, "devices": devices}, cache)
+        except:
+            return False
+        return True
@@ -0,0 +1,98 @@
+"""
+Garbage collection policy.
+
+Instead of a full gc.collect() after every request, the request paths
+only report that they allocated (request()) and the main loop asks the
+policy between events (idle()). A collection runs
+
+ * once the loop has been idle for idle_ms after the last request, at
+   most every interval_ms, or
+ * on the next pass of the loop if the free heap fell below low_free
+   (MicroPython only).
+
+On MicroPython gc.threshold() additionally lets the allocator collect
+before the heap runs out. The policy counts the inline collections it
+avoided and estimates the time saved from the measured collection time.
+"""
+import gc
+
+from hal import ticks_ms, ticks_us, ticks_diff
+
+class gc_policy:
+    def __init__(self, idle_ms=100, interval_ms=1000, low_free=16384, timing=None):
+        self.idle_ms = idle_ms
+        self.interval_ms = interval_ms
+        self.low_free = low_free
+        # metrics.timing of the collections (optional)
+        self.timing = timing
+        self.heap_info = hasattr(gc, "mem_free")
+        if self.heap_info and hasattr(gc, "threshold"):
+            # collect automatically after a quarter of the free heap has
+            # been allocated
+            gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+        now = ticks_ms()
+        self.last_request = now
+        self.last_collect = now
+        self.pending = 0  # requests since the last collection
+        self.requests = 0  # inline collections the request paths asked for
+        self.collections = 0
+        self.collect_us = 0
+        self.peak = 0  # highest heap allocation seen between events
+
+    def request(self):
+        # called where a request used to collect inline
+        self.pending += 1
+        self.requests += 1
+        self.last_request = ticks_ms()
+
+    def low_memory(self):
+        return self.heap_info and gc.mem_free() < self.low_free
+
+    def sample(self):
+        used = gc.mem_alloc()
+        if used > self.peak:
+            self.peak = used
+
+    def idle(self):
+        """
+         Called by the main loop between events, collects if it is due.
+         Returns True if it collected.
+        """
+        if self.heap_info:
+            self.sample()
+        if self.low_memory():
+            self.collect()
+            return True
+        now = ticks_ms()
+        if (
+            self.pending
+            and ticks_diff(now, self.last_request) >= self.idle_ms
+            and ticks_diff(now, self.last_collect) >= self.interval_ms
+        ):
+            self.collect()
+            return True
+        return False
+
+    def collect(self):
+        if self.heap_info:
+            # the heap is at its highest right before a collection
+            self.sample()
+        start = ticks_us()
+        gc.collect()
+        elapsed = ticks_diff(ticks_us(), start)
+        self.collections += 1
+        self.collect_us += elapsed
+        self.pending = 0
+        self.last_collect = ticks_ms()
+        if self.timing:
+            self.timing.add(elapsed)
+
+    def skipped(self):
+        # inline collections which did not run
+        return max(self.requests - self.collections, 0)
+
+    def saved_us(self):
+        # estimated from the mean time of the collections that ran
+        if not self.collections:
+            return 0
+        return self.skipped() * self.collect_us // self.collections
@@ -0,0 +1,189 @@
+"""
+Hardware abstraction layer of uPyEcho.
+
+main.py only talks to the hardware through this module, so the same
+fauxmo/upnp_broadcast_responder code runs on the board and as a service
+on a normal (Linux) host:
+
+ * board: MicroPython with machine/network (WLAN station, unique id of
+   the chip, wipyWS2812 strip, NTP synced RTC),
+ * host: CPython, an always connected station with the address of the
+   default route, the MAC address as unique id, the system clock,
+   simulated_ws2812, which records the frames instead of driving a strip,
+   and the resident memory of the process as its heap.
+
+The backend is selected by the modules available, `hosted` is True on
+the host. The ticks_ms/ticks_us/ticks_add/ticks_diff and _thread
+fallbacks for CPython are defined here as well, the other modules import
+them from hal.
+"""
+import time
+
+try:
+    import _thread
+
+    thread_available = True
+except:
+    _thread = None
+    thread_available = False
+try:
+    from time import ticks_ms, ticks_us, ticks_add, ticks_diff
+except:
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(ticks1, ticks2):
+        return ticks1 - ticks2
+
+
+try:
+    import machine
+    import network
+
+    hosted = False
+except:
+    hosted = True
+
+
+class simulated_ws2812:
+    """
+     Stand-in for the WS2812 driver on the host. It has the GRB buffer and
+     write() of MicroPython's neopixel driver, so the strip_renderer draws
+     into it directly. Every write() records a copy of the frame; the last
+     max_frames frames are kept in frames.
+    """
+
+    def __init__(self, ledNumber=1, brightness=100, max_frames=100):
+        self.ledNumber = ledNumber
+        self.brightness = brightness
+        self.buf = bytearray(3 * ledNumber)
+        self.max_frames = max_frames
+        self.frames = []
+        self.writes = 0
+
+    def write(self):
+        self.writes += 1
+        self.frames.append(bytes(self.buf))
+        if len(self.frames) > self.max_frames:
+            del self.frames[0]
+
+    def get_pixel(self, index, frame=-1):
+        # (r, g, b) of a LED in a recorded frame (default: the last one)
+        data = self.frames[frame]
+        offset = 3 * index
+        return (data[offset + 1], data[offset], data[offset + 2])
+
+
+if hosted:
+    import socket
+    import uuid
+    import platform
+    import resource
+
+    WS2812 = simulated_ws2812
+
+    class host_station:
+        # station interface of the host, which is already connected
+        def isconnected(self):
+            return True
+
+        def active(self, *args):
+            return True
+
+        def connect(self, *args):
+            pass
+
+        def ifconfig(self):
+            try:
+                address = local_ip_address()
+            except OSError:
+                # no default route, serve on the loopback interface
+                address = "127.0.0.1"
+            return (address, "255.255.255.0", "0.0.0.0", "0.0.0.0")
+
+    def station():
+        return host_station()
+
+    def unique_id():
+        return uuid.getnode().to_bytes(6, "big")
+
+    def local_ip_address():
+        # address of the interface of the default route, nothing is sent
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.connect(("239.255.255.250", 1900))
+            return probe.getsockname()[0]
+        finally:
+            probe.close()
+
+    def machine_name():
+        return platform.machine()
+
+    def heap_used():
+        # resident memory of the process
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+
+    def heap_peak():
+        # ru_maxrss is in kB on Linux and lags behind the current value
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return max(peak, heap_used())
+
+    def ntp_clock(server):
+        # the host keeps its own clock in sync
+        return time
+
+else:
+    import gc
+    from wipyWS2812.ws2812 import WS2812
+    from uos import uname
+
+    try:
+        from machine import RTC
+
+        if not hasattr(RTC, "ntp_sync"):
+            from ESP32MicroPython.timeutils import RTC
+    except:
+        from ESP32MicroPython.timeutils import RTC
+
+    def station():
+        return network.WLAN(network.STA_IF)
+
+    def unique_id():
+        return machine.unique_id()
+
+    def local_ip_address():
+        return network.WLAN().ifconfig()[0]
+
+    def machine_name():
+        return uname().machine
+
+    def heap_used():
+        return gc.mem_alloc()
+
+    def heap_free():
+        return gc.mem_free()
+
+    def ntp_clock(server):
+        """
+         Syncs the time with server and returns an object with a gmtime()
+         function, None if the board is not known.
+        """
+        if machine_name() == "WiPy with ESP32":
+            # Wipy 2.0
+            clock = RTC()
+            clock.ntp_sync(server)
+            return time
+        elif machine_name() == "ESP32 module with ESP32":
+            # Wemos ESP-WROOM-32
+            clock = RTC()
+            clock.ntp_sync(server)
+            return clock
+        return None
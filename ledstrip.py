@@ -0,0 +1,553 @@
+"""
+Frame buffer based renderer for WS2812 LED strips.
+
+The strip is kept in one preallocated GRB bytearray (3 bytes per LED).
+Fills and brightness/gamma scaling are done in place and the buffer is
+handed to the driver without creating per-LED Python objects:
+
+ * drivers with a GRB `buf` and `write()` (e.g. MicroPython's neopixel)
+   render directly from their own buffer,
+ * the SPI driver of wipyWS2812 (`buf`, `buf_bytes`, `send_buf()`) gets
+   the frame encoded into its SPI buffer through a lookup table,
+ * any other driver gets the pixels through `show()`.
+
+Brightness and gamma are applied through 256-entry lookup tables, so each
+device can have its own brightness at the cost of a table index.
+
+Several virtual switches can share one strip as segments (LED ranges),
+strip_compositor merges them into the frame buffer and only pushes the
+strip when something changed.
+
+Transitions (fade, ramp, chase) are run by effects_engine one frame per
+tick, from the main loop or from a render thread of its own, so a
+request never waits for an animation to finish. The effects are handed
+to the renderer through a command_ring.
+"""
+import time
+
+from hal import _thread, thread_available, ticks_ms, ticks_diff
+
+# gamma 2.8 correction for the perceived brightness
+GAMMA = bytes([int((i / 255) ** 2.8 * 255 + 0.5) for i in range(256)])
+
+# brightness tables by (brightness, gamma)
+tables = {}
+
+
+def brightness_table(brightness, gamma=False):
+    """
+     256-entry lookup table mapping a color value to its value scaled by
+     brightness (0-100 %) and optionally gamma corrected. Tables are shared
+     between all users of the same settings.
+    """
+    key = (brightness, gamma)
+    table = tables.get(key)
+    if table is None:
+        if gamma:
+            table = bytes([GAMMA[i * brightness // 100] for i in range(256)])
+        else:
+            table = bytes([i * brightness // 100 for i in range(256)])
+        tables[key] = table
+    return table
+
+
+# table of the effects, which work on already scaled colors
+LINEAR = brightness_table(100)
+
+
+def replicate(view, start, end, unit):
+    # fills view[start:end] with copies of its first `unit` bytes, doubling
+    # the copied block on every step
+    filled = unit
+    total = end - start
+    while filled < total:
+        count = min(filled, total - filled)
+        view[start + filled : start + filled + count] = view[start : start + count]
+        filled += count
+
+
+class strip_renderer:
+    """
+     Renders a WS2812 strip of led_count LEDs from a GRB frame buffer.
+     fill() and set_pixel() only change the buffer, show() pushes it to the
+     driver.
+    """
+
+    def __init__(self, driver, led_count, brightness=100, gamma=False):
+        self.driver = driver
+        self.led_count = led_count
+        self.gamma = gamma
+        self.set_brightness(brightness)
+        self.solid = False  # the whole frame holds a single color
+        buf = getattr(driver, "buf", None)
+        if buf is not None and hasattr(driver, "write") and len(buf) == 3 * led_count:
+            # render in place into the driver's own buffer
+            self.mode = "buffer"
+            self.frame = buf
+        else:
+            self.frame = bytearray(3 * led_count)
+            if (
+                buf is not None
+                and hasattr(driver, "send_buf")
+                and hasattr(driver, "buf_bytes")
+                and len(buf) == 12 * led_count
+            ):
+                self.mode = "spi"
+                self.encoding = self.spi_encoding(driver.buf_bytes)
+            else:
+                self.mode = "show"
+        self.view = memoryview(self.frame)
+
+    @staticmethod
+    def spi_encoding(buf_bytes):
+        # 4 SPI bytes for every color byte, two bits per SPI byte
+        table = bytearray(1024)
+        for value in range(256):
+            for bit in range(4):
+                table[value * 4 + bit] = buf_bytes[value >> (6 - 2 * bit) & 0x03]
+        return bytes(table)
+
+    def set_brightness(self, brightness):
+        # default table for fills without a table of their own
+        self.brightness = brightness
+        self.table = brightness_table(brightness, self.gamma)
+
+    def fill(self, color, start=0, end=None, table=None):
+        """
+         Fills the LEDs start..end-1 (default: all) with an (r, g, b) color
+         scaled by table (default: the strip brightness).
+        """
+        if end is None:
+            end = self.led_count
+        if end <= start:
+            return
+        if table is None:
+            table = self.table
+        red, green, blue = color
+        offset = 3 * start
+        frame = self.frame
+        frame[offset] = table[green]
+        frame[offset + 1] = table[red]
+        frame[offset + 2] = table[blue]
+        replicate(self.view, offset, 3 * end, 3)
+        self.solid = start == 0 and end == self.led_count
+
+    def clear(self):
+        self.fill((0, 0, 0))
+
+    def set_pixel(self, index, color, table=None):
+        if table is None:
+            table = self.table
+        red, green, blue = color
+        offset = 3 * index
+        self.frame[offset] = table[green]
+        self.frame[offset + 1] = table[red]
+        self.frame[offset + 2] = table[blue]
+        self.solid = False
+
+    def get_pixel(self, index):
+        # scaled (r, g, b) of a LED
+        offset = 3 * index
+        frame = self.frame
+        return (frame[offset + 1], frame[offset], frame[offset + 2])
+
+    def pixels(self):
+        # (r, g, b) per LED for drivers that only take tuples
+        frame = self.frame
+        for offset in range(0, 3 * self.led_count, 3):
+            yield (frame[offset + 1], frame[offset], frame[offset + 2])
+
+    def show(self):
+        if self.mode == "buffer":
+            self.driver.write()
+        elif self.mode == "spi":
+            self.encode(self.driver.buf)
+            self.driver.send_buf()
+        else:
+            self.driver.show(self.pixels())
+
+    def encode(self, buf):
+        encoding = self.encoding
+        frame = self.frame
+        # a single color only needs the first LED to be encoded
+        count = 3 if self.solid else 3 * self.led_count
+        index = 0
+        for offset in range(count):
+            value = frame[offset] * 4
+            buf[index] = encoding[value]
+            buf[index + 1] = encoding[value + 1]
+            buf[index + 2] = encoding[value + 2]
+            buf[index + 3] = encoding[value + 3]
+            index += 4
+        if self.solid:
+            replicate(memoryview(buf), 0, len(buf), 12)
+
+
+class strip_segment:
+    """
+     Range start..end-1 of the LEDs of a strip_compositor with its current
+     (scaled) color.
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.color = None
+
+
+class strip_compositor:
+    """
+     Shares one strip_renderer between several segments (LED ranges), each
+     driven by its own virtual switch. Filling a segment only records its
+     color; show() merges the changed segments into the frame buffer in the
+     order they were changed and pushes the strip only if anything changed.
+     Updates of several segments within one tick cost a single transfer.
+     It has the drawing interface of strip_renderer, fills and pixels
+     outside of the segments are written to the frame buffer directly.
+    """
+
+    def __init__(self, strip):
+        self.strip = strip
+        self.led_count = strip.led_count
+        self.segments = {}  # (start, end) -> strip_segment
+        self.changed = []
+        self.dirty = False
+
+    @property
+    def table(self):
+        return self.strip.table
+
+    def segment(self, start=0, end=None):
+        if end is None:
+            end = self.led_count
+        key = (start, end)
+        if key not in self.segments:
+            self.segments[key] = strip_segment(start, end)
+        return self.segments[key]
+
+    def fill(self, color, start=0, end=None, table=None):
+        if end is None:
+            end = self.led_count
+        segment = self.segments.get((start, end))
+        if segment is None:
+            self.draw(start, end)
+            self.strip.fill(color, start, end, table)
+            return
+        if table is None:
+            table = self.strip.table
+        color = (table[color[0]], table[color[1]], table[color[2]])
+        if color != segment.color:
+            segment.color = color
+            if segment in self.changed:
+                self.changed.remove(segment)
+            self.changed.append(segment)
+            self.dirty = True
+
+    def clear(self):
+        self.fill((0, 0, 0))
+
+    def set_pixel(self, index, color, table=None):
+        self.draw(index, index + 1)
+        self.strip.set_pixel(index, color, table)
+
+    def get_pixel(self, index):
+        for segment in reversed(self.changed):
+            if segment.start <= index < segment.end:
+                return segment.color
+        return self.strip.get_pixel(index)
+
+    def draw(self, start, end):
+        # a direct write to start..end-1: merges the pending segments first
+        # and forgets the color of the segments it paints over
+        self.merge()
+        for segment in self.segments.values():
+            if segment.start < end and start < segment.end:
+                segment.color = None
+        self.dirty = True
+
+    def merge(self):
+        # a merged segment paints over the segments it overlaps, which lose
+        # their color unless they are merged after it
+        changed = self.changed
+        for index in range(len(changed)):
+            segment = changed[index]
+            self.strip.fill(segment.color, segment.start, segment.end, LINEAR)
+            pending = changed[index + 1 :]
+            for other in self.segments.values():
+                if (
+                    other is not segment
+                    and other.start < segment.end
+                    and segment.start < other.end
+                    and other not in pending
+                ):
+                    other.color = None
+        self.changed = []
+
+    def show(self):
+        """
+         Pushes the strip if a segment changed. Returns True if it did.
+        """
+        if not self.dirty:
+            return False
+        self.merge()
+        self.dirty = False
+        self.strip.show()
+        return True
+
+
+class null_lock:
+    def acquire(self):
+        return True
+
+    def release(self):
+        pass
+
+
+class command_ring:
+    """
+     Bounded single-consumer ring which hands commands from the network
+     side to the render thread. put() may be called by several producers,
+     which are serialized by a lock held only while a slot is claimed;
+     get() is only called by the consumer and takes no lock, a slot is
+     published by moving head after it has been written.
+    """
+
+    def __init__(self, size=32):
+        self.slots = [None] * size
+        self.head = 0  # next slot to write
+        self.tail = 0  # next slot to read
+        if thread_available:
+            self.lock = _thread.allocate_lock()
+        else:
+            self.lock = null_lock()
+
+    def put(self, command):
+        # returns False if the ring is full
+        self.lock.acquire()
+        try:
+            head = self.head
+            following = (head + 1) % len(self.slots)
+            if following == self.tail:
+                return False
+            self.slots[head] = command
+            self.head = following
+            return True
+        finally:
+            self.lock.release()
+
+    def get(self):
+        # returns None if the ring is empty
+        tail = self.tail
+        if tail == self.head:
+            return None
+        command = self.slots[tail]
+        self.slots[tail] = None
+        self.tail = (tail + 1) % len(self.slots)
+        return command
+
+
+class effect:
+    """
+     Base class of the effects. begin() is called on the first tick,
+     render() on every tick with the time since the start and returns
+     False once the effect has finished. An effect covers the LEDs
+     start..end-1 (default: all).
+    """
+
+    def __init__(self, duration_ms, start=0, end=None):
+        self.duration_ms = duration_ms
+        self.start = start
+        self.end = end
+        self.started = None
+
+    def begin(self, strip):
+        if self.end is None:
+            self.end = strip.led_count
+
+    def render(self, strip, elapsed_ms):
+        return False
+
+    def overlaps(self, other):
+        return self.start < other.end and other.start < self.end
+
+
+class fade(effect):
+    """
+     Fades from the current color of the LEDs to color (scaled by table).
+     LEDs of different colors (e.g. the halves of a group) fade from their
+     own color, each run of LEDs of the same color is filled at once.
+    """
+
+    def __init__(self, color, duration_ms, table=None, start=0, end=None):
+        effect.__init__(self, duration_ms, start, end)
+        self.color = color
+        self.table = table
+
+    def begin(self, strip):
+        effect.begin(self, strip)
+        table = self.table if self.table is not None else strip.table
+        self.target = (table[self.color[0]], table[self.color[1]], table[self.color[2]])
+        # runs of LEDs with the same current color: (start, end, color)
+        self.runs = []
+        run_start = self.start
+        origin = strip.get_pixel(run_start)
+        for index in range(self.start + 1, self.end):
+            color = strip.get_pixel(index)
+            if color != origin:
+                self.runs.append((run_start, index, origin))
+                run_start = index
+                origin = color
+        self.runs.append((run_start, self.end, origin))
+
+    def render(self, strip, elapsed_ms):
+        if elapsed_ms >= self.duration_ms:
+            strip.fill(self.target, self.start, self.end, LINEAR)
+            return False
+        step = elapsed_ms * 256 // self.duration_ms
+        for start, end, origin in self.runs:
+            color = [
+                value + ((target - value) * step >> 8)
+                for value, target in zip(origin, self.target)
+            ]
+            strip.fill(color, start, end, LINEAR)
+        return True
+
+
+class ramp(fade):
+    """
+     Ramps the brightness of color up from off.
+    """
+
+    def begin(self, strip):
+        fade.begin(self, strip)
+        self.runs = [(self.start, self.end, (0, 0, 0))]
+
+
+class chase(effect):
+    """
+     A block of length LEDs in color running along the LEDs, one round
+     every period_ms, on a dark background. Runs until it is replaced if
+     no duration is given.
+    """
+
+    def __init__(
+        self,
+        color,
+        period_ms,
+        length=8,
+        duration_ms=None,
+        table=None,
+        start=0,
+        end=None,
+    ):
+        effect.__init__(self, duration_ms, start, end)
+        self.color = color
+        self.period_ms = period_ms
+        self.length = length
+        self.table = table
+
+    def render(self, strip, elapsed_ms):
+        if self.duration_ms is not None and elapsed_ms >= self.duration_ms:
+            strip.fill((0, 0, 0), self.start, self.end)
+            return False
+        count = self.end - self.start
+        position = (elapsed_ms % self.period_ms) * count // self.period_ms
+        head = self.start + position
+        tail = head + min(self.length, count)
+        strip.fill((0, 0, 0), self.start, self.end)
+        strip.fill(self.color, head, min(tail, self.end), self.table)
+        if tail > self.end:
+            # wrap around to the start of the range
+            strip.fill(self.color, self.start, self.start + tail - self.end, self.table)
+        return True
+
+
+class effects_engine:
+    """
+     Runs the effects of a strip_renderer (or strip_compositor) without
+     blocking: start() only queues an effect, tick() renders one frame of
+     every running effect and pushes the strip once. An effect replaces the
+     running effects it overlaps. Effects started together by start_all()
+     begin on the same tick, so they reach the strip in a single
+     transmission. tick() is called by the main loop or, after
+     start_thread(), by a render thread of its own, which is blocked on a
+     lock while no effect runs. The effects reach tick() through a
+     command_ring, so only tick() uses the running effects and the
+     strip, and a long push of the strip holds no lock the network side
+     could wait for.
+    """
+
+    def __init__(self, strip, tick_ms=20, queue_size=32):
+        self.strip = strip
+        self.tick_ms = tick_ms
+        self.effects = []  # only used by tick()
+        self.commands = command_ring(queue_size)
+        self.threaded = False
+        # released by start_all() to wake up the idle render thread
+        self.wakeup = None
+        # set by the asyncio engine to wake up its effects task
+        self.event = None
+
+    def start(self, new_effect):
+        return self.start_all((new_effect,))
+
+    def start_all(self, new_effects):
+        """
+         Queues the effects for the next tick. Returns False if the queue is
+         full.
+        """
+        if not self.commands.put(tuple(new_effects)):
+            return False
+        if self.wakeup:
+            # the ring lock keeps two producers from releasing it twice
+            self.commands.lock.acquire()
+            if self.wakeup.locked():
+                self.wakeup.release()
+            self.commands.lock.release()
+        elif self.event:
+            self.event.set()
+        return True
+
+    def take(self):
+        # moves the queued effects to the running ones
+        new_effects = self.commands.get()
+        while new_effects is not None:
+            for new_effect in new_effects:
+                if new_effect.end is None:
+                    new_effect.end = self.strip.led_count
+                self.effects = [e for e in self.effects if not e.overlaps(new_effect)]
+                self.effects.append(new_effect)
+            new_effects = self.commands.get()
+
+    def tick(self):
+        """
+         Renders the next frame. Returns True while effects are running.
+        """
+        self.take()
+        if not self.effects:
+            return False
+        now = ticks_ms()
+        running = []
+        for current in self.effects:
+            if current.started is None:
+                current.started = now
+                current.begin(self.strip)
+            if current.render(self.strip, ticks_diff(now, current.started)):
+                running.append(current)
+        self.effects = running
+        self.strip.show()
+        return len(running) > 0
+
+    def run(self):
+        while True:
+            if self.tick():
+                time.sleep(self.tick_ms / 1000)
+            else:
+                # idle until start_all() queues effects
+                self.wakeup.acquire()
+
+    def start_thread(self):
+        self.threaded = True
+        self.wakeup = _thread.allocate_lock()
+        self.wakeup.acquire()
+        _thread.start_new_thread(self.run, ())
@@ -26,21 +26,12 @@ More info about the MicroPython Version see https://lemariva.com
 
 """
 import gc
-import machine
-import network
 import time
 
-try:
-    import _thread
-
-    thread_available = True
-except:
-    thread_available = False
-
 try:
     import uselect as select
 except:
-    import socket
+    import select
 try:
     import usocket as socket
 except:
@@ -49,18 +40,33 @@ try:
     import ustruct as struct
 except:
     import struct
-
-# for ws2812b
-from wipyWS2812.ws2812 import WS2812
-from uos import uname
-
+# (u)asyncio is imported by import_asyncio() only for the "asyncio" engine
+asyncio = None
 try:
-    from machine import RTC
-
-    if not hasattr(RTC, "ntp_sync"):
-        from ESP32MicroPython.timeutils import RTC
+    import urandom as random
+except:
+    import random
+try:
+    from ubinascii import crc32, hexlify
 except:
-    from ESP32MicroPython.timeutils import RTC
+    from binascii import crc32, hexlify
+# board or host backend (WLAN, unique id, ws2812b, RTC)
+import hal
+from hal import _thread, thread_available
+from hal import ticks_ms, ticks_us, ticks_add, ticks_diff
+import metrics
+from gcpolicy import gc_policy
+from statestore import state_store
+from devconfig import device_config
+from startup import wlan_connector, clock_sync
+from ledstrip import (
+    strip_renderer,
+    strip_compositor,
+    brightness_table,
+    effects_engine,
+    fade,
+    null_lock,
+)
 
 # This XML is the minimum needed to define one of our virtual switches
 # to the Amazon Echo Dot / Amazon Echo (2nd generation)
@@ -80,9 +86,9 @@ SETUP_XML = """<?xml version="1.0"?>
       <service>
           <serviceType>urn:Belkin:service:basicevent:1</serviceType>
           <serviceId>urn:Belkin:serviceId:basicevent1</serviceId>
-          <controlURL>/upnp/control/basicevent1</controlURL>
-          <eventSubURL>/upnp/event/basicevent1</eventSubURL>
-          <SCPDURL>/eventservice.xml</SCPDURL>
+          <controlURL>%(url_base)s/upnp/control/basicevent1</controlURL>
+          <eventSubURL>%(url_base)s/upnp/event/basicevent1</eventSubURL>
+          <SCPDURL>%(url_base)s/eventservice.xml</SCPDURL>
       </service>
     </serviceList>
   </device>
@@ -128,44 +134,156 @@ GetBinaryState_soap = """<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/en
 
 DEBUG = True
 
+# "poll": poller-based main loop.
+# "asyncio": every socket is served by a task woken on socket readiness, not
+# yet run on hardware. Falls back to "poll" if (u)asyncio is not available.
+ENGINE = "poll"
+
 INADDR_ANY = 0
+# worker threads running the on()/off() calls of the handlers if a thread
+# pool is available (CPython); otherwise a single _thread worker is used
+ACTUATION_WORKERS = 4
+# size of the receive buffer of every HTTP client connection (bytes), which
+# limits the size of a single request
+REQUEST_BUFFER_SIZE = 2048
+# HTTP client connections kept open at the same time (over all listeners).
+# If the limit is reached, the least recently used connection is closed.
+MAX_CONNECTIONS = 4
+if hal.hosted:
+    # no socket limit on the host
+    MAX_CONNECTIONS = 64
+# kept-alive connections without traffic are closed after this time (ms)
+IDLE_TIMEOUT_MS = 10000
+# All virtual switches are served from one listening socket on this port and
+# told apart by the URL prefix /<serial>/. Set to None to fall back to one
+# listening socket per device (limited by the number of sockets available).
+SHARED_HTTP_PORT = 49153
+# repeated M-SEARCH requests of a sender for the same search target are
+# only answered once per window (ms)
+SSDP_DEDUP_WINDOW_MS = 5000
+# SSDP replies per second (token bucket) and the size of a burst
+SSDP_REPLY_RATE = 32
+SSDP_REPLY_BURST = 64
 global_epoch = 0  # time over ntp-server
+# devices (and WLAN credentials, see boot.py); the strings derived from the
+# devices are cached in CONFIG_FILE + ".cache"
+CONFIG_FILE = "config.json"
+# snapshot of the device states (relay, color, brightness), the relay state
+# is restored on boot
+STATE_FILE = "state.json"
+# changes are written once no further change happened for this time (ms)
+STATE_DEBOUNCE_MS = 2000
 
 # W2812b
 ledNumber = 144  # number of leds
+GAMMA_CORRECTION = False  # gamma correct the colors of the strip
 chain = []
-clock = None
-
-
-def dbg(msg):
-    global DEBUG
+TRANSITION_MS = 500  # duration of the fade when a device is switched
+EFFECTS_THREAD = True  # render the effects on a thread of their own if possible
+strip = None  # strip_renderer of ws2812_chain
+compositor = None  # strip_compositor merging the segments of the devices
+effects = None  # effects_engine of compositor
+# gmtime() of the DATE headers: the time since boot until the NTP sync
+clock = time
+NTP_SERVER = "time1.google.com"
+
+
+def dbg(msg, *args):
+    # arguments are only formatted into msg if DEBUG is enabled, so debug
+    # output on the request path costs nothing when it is disabled
     if DEBUG:
+        if args:
+            msg = msg % args
         print(msg)
 
 
+device_states = state_store(STATE_FILE, STATE_DEBOUNCE_MS, log=dbg)
+
+# instrumentation of the hot paths, served on /metrics
+EVENT_TIME = metrics.timing(
+    "upyecho_event_seconds", "Handling of a readable socket by the poller"
+)
+ACCEPT_TIME = metrics.timing("upyecho_accept_seconds", "Accepting an HTTP client")
+RECV_TIME = metrics.timing("upyecho_recv_seconds", "Receiving from an HTTP client")
+PARSE_TIME = metrics.timing("upyecho_parse_seconds", "Parsing an HTTP request")
+ACTUATE_TIME = metrics.timing("upyecho_actuate_seconds", "Running a device handler")
+SEND_TIME = metrics.timing("upyecho_send_seconds", "Sending an HTTP response")
+SSDP_SEND_TIME = metrics.timing("upyecho_ssdp_send_seconds", "Sending an SSDP reply")
+GC_TIME = metrics.timing("upyecho_gc_seconds", "gc.collect() calls")
+MSEARCH_COUNT = metrics.counter("upyecho_msearch_total", "M-SEARCH requests received")
+MSEARCH_SUPPRESSED = metrics.counter(
+    "upyecho_msearch_suppressed_total", "Repeated M-SEARCH requests not answered"
+)
+MSEARCH_LIMITED = metrics.counter(
+    "upyecho_msearch_limited_total", "M-SEARCH requests dropped by the rate limit"
+)
+SSDP_RESPONSES = metrics.counter("upyecho_ssdp_responses_total", "SSDP replies sent")
+HTTP_REQUESTS = metrics.counter("upyecho_http_requests_total", "HTTP requests")
+HTTP_RESPONSES = metrics.counter("upyecho_http_responses_total", "HTTP responses")
+ERRORS = metrics.counter("upyecho_errors_total", "Failed requests, sends and handlers")
+
+# gc.collect() only runs between events, see gcpolicy.py
+collector = gc_policy(timing=GC_TIME)
+metrics.gauge(
+    "upyecho_gc_skipped_total",
+    "Inline gc.collect() calls avoided by the policy",
+    collector.skipped,
+)
+metrics.gauge(
+    "upyecho_gc_saved_seconds",
+    "Estimated collection time saved by the policy",
+    lambda: collector.saved_us() / 1000000,
+)
+
+
+def heap_peak():
+    # sampled between events by the collector on the board
+    if hal.hosted:
+        return hal.heap_peak()
+    return max(collector.peak, hal.heap_used())
+
+
+metrics.gauge(
+    "upyecho_heap_used_bytes",
+    "Heap in use (resident memory when hosted)",
+    hal.heap_used,
+)
+metrics.gauge(
+    "upyecho_heap_peak_bytes",
+    "Peak heap in use (peak resident memory when hosted)",
+    heap_peak,
+)
+if not hal.hosted:
+    metrics.gauge("upyecho_heap_free_bytes", "Free heap", hal.heap_free)
+
+
 def inet_aton(addr):
     ip_as_bytes = bytes(map(int, addr.split(".")))
     return ip_as_bytes
 
 
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = (
+    "Jan",
+    "Feb",
+    "Mar",
+    "Apr",
+    "May",
+    "Jun",
+    "Jul",
+    "Aug",
+    "Sep",
+    "Oct",
+    "Nov",
+    "Dec",
+)
+
+
 def format_timetuple_and_zone(timetuple, zone):
     return "%s, %02d %s %04d %02d:%02d:%02d %s" % (
-        ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"][timetuple[6]],
+        WEEKDAYS[timetuple[6]],
         timetuple[2],
-        [
-            "Jan",
-            "Feb",
-            "Mar",
-            "Apr",
-            "May",
-            "Jun",
-            "Jul",
-            "Aug",
-            "Sep",
-            "Oct",
-            "Nov",
-            "Dec",
-        ][timetuple[1] - 1],
+        MONTHS[timetuple[1] - 1],
         timetuple[0],
         timetuple[3],
         timetuple[4],
@@ -174,6 +292,151 @@ def format_timetuple_and_zone(timetuple, zone):
     )
 
 
+class http_date:
+    """
+     Date for the DATE headers (RFC 1123). It is formatted at most once per
+     second of wall-clock time, every other caller gets the cached value.
+    """
+
+    def __init__(self):
+        self.second = None
+        self.text = ""
+        self.value = b""
+
+    def update(self):
+        now = int(time.time())
+        if now != self.second:
+            self.second = now
+            self.text = format_timetuple_and_zone(clock.gmtime(), "GMT")
+            self.value = self.text.encode()
+
+    def get(self):
+        self.update()
+        return self.value
+
+    def get_str(self):
+        self.update()
+        return self.text
+
+
+date_header = http_date()
+
+
+# Headers that follow DATE in the responses to the Echo
+SOAP_HEADERS = (
+    "EXT:\r\n"
+    "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+    "X-User-Agent: redsonic\r\n"
+)
+XML_HEADERS = (
+    "LAST-MODIFIED: Sat, 01 Jan 2000 00:01:15 GMT\r\n"
+    "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+    "X-User-Agent: redsonic\r\n"
+)
+
+
+class cached_response:
+    """
+     HTTP response that is rendered and encoded only once. Per request only
+     the DATE header, the CONNECTION header and, if a state_marker is given,
+     the single state digit following it in the body are patched into the
+     preallocated buffer.
+    """
+
+    DATE_LENGTH = 29  # len("Sat, 01 Jan 2000 00:01:15 GMT")
+    # both values take the same space, the padding is allowed whitespace
+    KEEP_ALIVE = b"keep-alive"
+    CLOSE = b"close     "
+
+    def __init__(self, content_type, headers, body, state_marker=None):
+        body = body.encode()
+        head = (
+            "HTTP/1.1 200 OK\r\n"
+            "CONTENT-LENGTH: %d\r\n"
+            "CONTENT-TYPE: %s\r\n"
+            "DATE: " % (len(body), content_type)
+        ).encode()
+        tail = ("\r\n" + headers + "CONNECTION: ").encode()
+        self.date_offset = len(head)
+        self.connection_offset = len(head) + self.DATE_LENGTH + len(tail)
+        self.buffer = bytearray(
+            head + b" " * self.DATE_LENGTH + tail + self.CLOSE + b"\r\n\r\n" + body
+        )
+        self.state_offset = None
+        if state_marker:
+            body_offset = len(self.buffer) - len(body) + len(state_marker)
+            self.state_offset = body_offset + body.find(state_marker)
+
+    def render(self, date, state=None, keep_alive=False):
+        self.buffer[self.date_offset : self.date_offset + self.DATE_LENGTH] = date
+        offset = self.connection_offset
+        if keep_alive:
+            self.buffer[offset : offset + 10] = self.KEEP_ALIVE
+        else:
+            self.buffer[offset : offset + 10] = self.CLOSE
+        if state is not None:
+            self.buffer[self.state_offset] = 0x30 + state  # ord("0") + state
+        return self.buffer
+
+
+class ssdp_response:
+    """
+     Search reply of a device. It is encoded once per search target (ST,
+     which is repeated in USN); per reply only the DATE header is patched
+     into the buffer.
+    """
+
+    MAX_TARGETS = 4  # buffers kept per device
+
+    def __init__(self, template):
+        self.head = (
+            "HTTP/1.1 200 OK\r\nCACHE-CONTROL: max-age=86400\r\nDATE: "
+        ).encode()
+        self.tail = template
+        self.buffers = {}
+
+    @staticmethod
+    def template(location, nls, server, persistent_uuid, other_headers=None):
+        # headers following DATE, ST and USN are left as %s for the target
+        tail = (
+            "\r\n"
+            "EXT:\r\n"
+            "LOCATION: %s\r\n"
+            'OPT: "http://schemas.upnp.org/upnp/1/0/"; ns=01\r\n'
+            "01-NLS: %s\r\n"
+            "SERVER: %s\r\n"
+            % (location, nls, server)
+        )
+        tail += "ST: %%s\r\nUSN: uuid:%s::%%s\r\n" % persistent_uuid
+        if other_headers:
+            for header in other_headers:
+                tail += header + "\r\n"
+        return tail + "\r\n"
+
+    def render(self, date, search_target):
+        buffer = self.buffers.get(search_target)
+        if buffer is None:
+            buffer = bytearray(
+                self.head
+                + b" " * cached_response.DATE_LENGTH
+                + (self.tail % (search_target, search_target)).encode()
+            )
+            if len(self.buffers) < self.MAX_TARGETS:
+                self.buffers[search_target] = buffer
+        offset = len(self.head)
+        buffer[offset : offset + cached_response.DATE_LENGTH] = date
+        return buffer
+
+
+EVENTSERVICE_RESPONSE = cached_response("text/xml", XML_HEADERS, eventservice_xml)
+BINARYSTATE_RESPONSE = cached_response(
+    'text/xml charset="utf-8"',
+    SOAP_HEADERS,
+    GetBinaryState_soap % {"state_realy": 0},
+    state_marker=b"<BinaryState>",
+)
+
+
 class poller:
     # A simple utility class to wait for incoming data to be
     # read on a socket.
@@ -181,45 +444,545 @@ class poller:
         if "poll" in dir(select):
             self.use_poll = True
             self.poller = select.poll()
+            # MicroPython's poll returns the registered objects, CPython's
+            # returns their filenos
+            self.by_fileno = not hasattr(self.poller, "ipoll")
         else:
             self.use_poll = False
+            self.by_fileno = False
+        # poll result -> (do_read handler, socket)
         self.targets = {}
+        self.sockets = []
 
     def add(self, target, socket=None):
         if not socket:
             socket = target.sockets()
         if self.use_poll:
             self.poller.register(socket, select.POLLIN)
-        # dbg("add device on fileno: %s" % socket.fileno() )
-        self.targets[socket.fileno()] = target
-        # dbg("size targets: %s" % len(self.targets))
+        else:
+            self.sockets.append(socket)
+        key = socket.fileno() if self.by_fileno else socket
+        self.targets[key] = (target.do_read, socket)
 
     def remove(self, target, socket=None):
         if not socket:
             socket = target.sockets()
         if self.use_poll:
             self.poller.unregister(socket)
-        # dbg("remove device on fileno: %s" % socket.fileno() )
-        gc.collect()
+        elif socket in self.sockets:
+            self.sockets.remove(socket)
+        key = socket.fileno() if self.by_fileno else socket
+        self.targets.pop(key, None)
+        collector.request()
 
     def poll(self, timeout=100):
         if self.use_poll:
             ready = self.poller.poll(timeout)
         else:
             ready = []
-            if len(self.targets) > 0:
+            if self.sockets:
                 (rlist, wlist, xlist) = select.select(
-                    self.targets.keys(), [], [], timeout
+                    self.sockets, [], [], timeout / 1000
                 )
                 ready = [(x, None) for x in rlist]
 
+        targets = self.targets
         for one_ready in ready:
-            target = self.targets.get(one_ready[0].fileno(), None)
-            dbg("Targets %s" % str(self.targets.keys()))
+            target = targets.get(one_ready[0])
             if target:
-                # dbg("get socket with fileno: %s" % str(one_ready[0].fileno()) +  " len: %s" % len(one_ready) + " selected: %s " % str(target.fileno()) )
-                # update time
-                target.do_read(one_ready[0])
+                start = ticks_us()
+                target[0](target[1])
+                EVENT_TIME.since(start)
+
+
+def uasyncio_wait_readable(sock):
+    # uasyncio: park the task in the I/O queue until the socket is readable
+    yield asyncio.core._io_queue.queue_read(sock)
+
+
+def uasyncio_release_readable(sock):
+    # cancelling the waiting task removes the socket from the I/O queue
+    pass
+
+
+async def loop_wait_readable(sock):
+    loop = asyncio.get_event_loop()
+    ready = loop.create_future()
+
+    def wake():
+        if not ready.done():
+            ready.set_result(None)
+
+    loop.add_reader(sock.fileno(), wake)
+    try:
+        await ready
+    finally:
+        # a closed socket was already released by the poller
+        if sock.fileno() != -1:
+            loop.remove_reader(sock.fileno())
+
+
+def loop_release_readable(sock):
+    # the fileno has to be released before the socket is closed
+    asyncio.get_event_loop().remove_reader(sock.fileno())
+
+
+wait_readable = uasyncio_wait_readable
+release_readable = uasyncio_release_readable
+
+
+def import_asyncio():
+    """
+     Imports (u)asyncio for the "asyncio" engine, the "poll" engine does not
+     spend heap on it. Returns False if it is not available.
+    """
+    global asyncio, wait_readable, release_readable
+    try:
+        import uasyncio as asyncio
+    except:
+        try:
+            import asyncio
+        except:
+            return False
+    if not hasattr(asyncio, "create_task"):
+        return False
+    if not hasattr(asyncio, "core"):
+        wait_readable = loop_wait_readable
+        release_readable = loop_release_readable
+    return True
+
+
+class async_poller:
+    """
+     Drop-in replacement for poller on top of (u)asyncio. Each registered
+     socket is served by its own task, which sleeps until the socket is
+     readable and then calls target.do_read(socket) like poller.poll does.
+    """
+
+    def __init__(self):
+        self.targets = {}
+        self.tasks = {}
+        self.serving = None
+
+    def add(self, target, socket=None):
+        if not socket:
+            socket = target.sockets()
+        fileno = socket.fileno()
+        self.targets[fileno] = target
+        self.tasks[fileno] = asyncio.create_task(self.serve(target, socket, fileno))
+
+    def remove(self, target, socket=None):
+        if not socket:
+            socket = target.sockets()
+        fileno = socket.fileno()
+        self.targets.pop(fileno, None)
+        task = self.tasks.pop(fileno, None)
+        # a task removing its own socket just leaves its loop
+        if task and fileno != self.serving:
+            release_readable(socket)
+            task.cancel()
+        collector.request()
+
+    async def serve(self, target, socket, fileno):
+        task = self.tasks[fileno]
+        while self.tasks.get(fileno) is task:
+            await wait_readable(socket)
+            self.serving = fileno
+            start = ticks_us()
+            try:
+                target.do_read(socket)
+            except Exception as e:
+                ERRORS.inc()
+                dbg(e)
+            EVENT_TIME.since(start)
+            self.serving = None
+
+
+if hasattr(bytearray, "find"):
+
+    def buffer_find(buffer, sub, start, end):
+        return buffer.find(sub, start, end)
+
+else:
+    # MicroPython's bytearray has no find(), search a copy of the window
+    def buffer_find(buffer, sub, start, end):
+        found = bytes(memoryview(buffer)[start:end]).find(sub)
+        if found == -1:
+            return -1
+        return start + found
+
+
+class http_request:
+    """
+     A request parsed by http_connection: method and path of the request
+     line, the headers (lower case names) and the body.
+    """
+
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class http_connection:
+    """
+     Client connection of an http_listener. Requests are parsed incrementally
+     in a reusable buffer, so a request may arrive in several packets and
+     several requests may be pipelined on a kept-alive connection.
+     After next_request() returned a request, keep_alive tells whether the
+     connection stays open after it.
+    """
+
+    def __init__(self, socket, address):
+        self.socket = socket
+        self.address = address
+        if hasattr(socket, "recv_into"):
+            self.recv_into = socket.recv_into
+        else:
+            self.recv_into = self.recv_copy
+        self.buffer = bytearray(REQUEST_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte of the current request
+        self.fill = 0  # end of the received data
+        self.overflow = False
+        self.malformed = False  # the head could not be parsed
+        self.keep_alive = False
+        self.last_active = ticks_ms()
+        self.reset()
+
+    def reset(self):
+        self.head_end = -1
+        self.content_length = 0
+        self.method = None
+        self.path = None
+        self.headers = None
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def recv_copy(self, view):
+        # MicroPython sockets have no recv_into() and readinto() of a
+        # blocking socket only returns once the whole view is filled, recv()
+        # returns what has arrived
+        data = self.socket.recv(len(view))
+        view[: len(data)] = data
+        return len(data)
+
+    def send(self, data):
+        return self.socket.send(data)
+
+    def send_error(self, status):
+        # answers a request which has no other response; the connection is
+        # closed after it, so later pipelined requests cannot get the
+        # responses out of step
+        self.keep_alive = False
+        self.send(
+            b"HTTP/1.1 "
+            + status
+            + b"\r\nCONTENT-LENGTH: 0\r\nCONNECTION: close\r\n\r\n"
+        )
+
+    def close(self):
+        self.socket.close()
+
+    def receive(self):
+        """
+         Reads the available data into the buffer. Returns False if the
+         client closed the connection.
+        """
+        if self.start == self.fill:
+            self.start = self.fill = 0
+        elif self.fill == len(self.buffer):
+            # move the pending request to the front to make room
+            pending = self.fill - self.start
+            self.buffer[:pending] = bytes(self.view[self.start : self.fill])
+            if self.head_end != -1:
+                self.head_end -= self.start
+            self.start, self.fill = 0, pending
+        if self.fill == len(self.buffer):
+            self.overflow = True
+            return True
+        count = self.recv_into(self.view[self.fill :])
+        if not count:
+            return False
+        self.fill += count
+        self.last_active = ticks_ms()
+        return True
+
+    def parse_head(self):
+        end = buffer_find(self.buffer, b"\r\n\r\n", self.start, self.fill)
+        if end == -1:
+            return False
+        lines = bytes(self.view[self.start : end]).split(b"\r\n")
+        request_line = lines[0].split(b" ")
+        self.method = request_line[0]
+        self.path = request_line[1] if len(request_line) > 1 else b""
+        version = request_line[2] if len(request_line) > 2 else b"HTTP/1.0"
+        self.headers = {}
+        for line in lines[1:]:
+            colon = line.find(b":")
+            if colon > 0:
+                self.headers[line[:colon].strip().lower()] = line[colon + 1 :].strip()
+        try:
+            self.content_length = int(self.headers.get(b"content-length", 0))
+        except ValueError:
+            self.content_length = -1
+        if self.content_length < 0:
+            # the end of the request is unknown, no further request on this
+            # connection can be parsed
+            self.malformed = True
+            return False
+        connection = self.headers.get(b"connection", b"").lower()
+        if version == b"HTTP/1.1":
+            self.keep_alive = connection != b"close"
+        else:
+            self.keep_alive = connection == b"keep-alive"
+        self.head_end = end + 4
+        return True
+
+    def next_request(self):
+        """
+         Returns the next complete request as http_request or None if it has
+         not been received completely yet.
+        """
+        if self.head_end == -1 and not self.parse_head():
+            return None
+        end = self.head_end + self.content_length
+        if end > self.fill:
+            if end - self.start > len(self.buffer):
+                self.overflow = True
+            return None
+        request = http_request(
+            self.method, self.path, self.headers, bytes(self.view[self.head_end : end])
+        )
+        self.start = end
+        self.head_end = -1
+        return request
+
+
+class connection_table:
+    """
+     Client connections of the HTTP listeners by fileno. The number of open
+     connections is capped by evicting the least recently used one, and
+     connections idle for longer than the timeout are closed by expire().
+    """
+
+    def __init__(self, max_connections, idle_timeout_ms):
+        self.max_connections = max_connections
+        self.idle_timeout_ms = idle_timeout_ms
+        self.connections = {}
+
+    def __len__(self):
+        return len(self.connections)
+
+    def get(self, fileno):
+        return self.connections.get(fileno)
+
+    def add(self, listener, connection):
+        while len(self.connections) >= self.max_connections:
+            self.evict()
+        connection.listener = listener
+        self.connections[connection.fileno()] = connection
+
+    def remove(self, connection):
+        self.connections.pop(connection.fileno(), None)
+
+    def evict(self):
+        oldest = None
+        for connection in self.connections.values():
+            if oldest is None or ticks_diff(
+                connection.last_active, oldest.last_active
+            ) < 0:
+                oldest = connection
+        dbg("Evicting connection on socket %s", oldest.fileno())
+        oldest.listener.close(oldest)
+
+    def expire(self):
+        now = ticks_ms()
+        for connection in list(self.connections.values()):
+            if ticks_diff(now, connection.last_active) > self.idle_timeout_ms:
+                dbg("Closing idle connection on socket %s", connection.fileno())
+                connection.listener.close(connection)
+
+
+client_connections = connection_table(MAX_CONNECTIONS, IDLE_TIMEOUT_MS)
+
+
+class http_listener:
+    """
+     Listening TCP socket. Accepts clients, reads their requests and passes
+     them to handler.handle_request(request, sender, connection). Connections
+     are kept open for further requests unless the client or the handler
+     (by clearing connection.keep_alive) asks to close them. GET /metrics
+     is answered by the listener itself, on every HTTP port.
+    """
+
+    def __init__(self, poller, ip_address, port, handler, connections=None):
+        self.poller = poller
+        self.handler = handler
+        if connections is None:
+            connections = client_connections
+        self.connections = connections
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((ip_address, port))
+        self.socket.listen(5)
+        if port == 0:
+            port = self.socket.getsockname()[1]
+        self.port = port
+        self.poller.add(self)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def sockets(self):
+        return self.socket
+
+    def close(self, connection):
+        self.poller.remove(self, connection.socket)
+        self.connections.remove(connection)
+        connection.close()
+
+    def do_read(self, socket):
+        fileno = socket.fileno()
+
+        if fileno == self.socket.fileno():
+            start = ticks_us()
+            try:
+                (client_socket, client_address) = self.socket.accept()
+                self.connections.add(
+                    self, http_connection(client_socket, client_address)
+                )
+                self.poller.add(self, client_socket)
+            except Exception as e:
+                ERRORS.inc()
+                dbg("################################## Socket busy! %s", e)
+            ACCEPT_TIME.since(start)
+        else:
+            connection = self.connections.get(fileno)
+            if connection is None:
+                dbg("Unknown client socket %s", fileno)
+                return
+            start = ticks_us()
+            try:
+                received = connection.receive()
+            except Exception as e:
+                ERRORS.inc()
+                dbg("Receive failed: %s", e)
+                received = False
+            RECV_TIME.since(start)
+            if not received:
+                self.close(connection)
+                collector.request()
+                return
+
+            start = ticks_us()
+            request = connection.next_request()
+            PARSE_TIME.since(start)
+            while request is not None:
+                HTTP_REQUESTS.inc()
+                try:
+                    if request.path == b"/metrics" and request.method == b"GET":
+                        self.send_metrics(connection)
+                    else:
+                        self.handler.handle_request(
+                            request, connection.address, connection
+                        )
+                except Exception as e:
+                    ERRORS.inc()
+                    dbg("Request failed: %s", e)
+                    connection.send_error(b"500 Internal Server Error")
+                if not connection.keep_alive:
+                    self.close(connection)
+                    break
+                start = ticks_us()
+                request = connection.next_request()
+                PARSE_TIME.since(start)
+            else:
+                if connection.overflow:
+                    ERRORS.inc()
+                    dbg("Request too large on socket %s", fileno)
+                    connection.send_error(b"413 Payload Too Large")
+                    self.close(connection)
+                elif connection.malformed:
+                    ERRORS.inc()
+                    dbg("Malformed request on socket %s", fileno)
+                    connection.send_error(b"400 Bad Request")
+                    self.close(connection)
+            collector.request()
+
+    def send_metrics(self, socket):
+        body = metrics.render()
+        head = (
+            "HTTP/1.1 200 OK\r\n"
+            "CONTENT-LENGTH: %d\r\n"
+            "CONTENT-TYPE: text/plain; version=0.0.4\r\n"
+            "DATE: %s\r\n"
+            "CONNECTION: %s\r\n"
+            "\r\n"
+            % (
+                len(body),
+                date_header.get_str(),
+                "keep-alive" if socket.keep_alive else "close",
+            )
+        )
+        socket.send(head.encode() + body)
+
+
+class upnp_http_server(http_listener):
+    """
+     A single HTTP listener shared by several virtual devices. Each device
+     is published under its own URL prefix, e.g. /<serial>/setup.xml or
+     /<serial>/upnp/control/basicevent1. The prefix is stripped from the
+     path before the request is handed to the device, so devices handle
+     the same requests as if they had a socket of their own.
+    """
+
+    def __init__(self, poller, port, ip_address=None):
+        if not ip_address:
+            ip_address = upnp_device.local_ip_address()
+        self.ip_address = ip_address
+        self.devices = {}
+        http_listener.__init__(self, poller, ip_address, port, self)
+
+    def add_device(self, device, url_key):
+        other = self.devices.get(url_key.encode())
+        if other is not None:
+            # the serial is derived from the name and may collide
+            raise DuplicateDeviceException(
+                "Devices '{}' and '{}' have the same serial {}, rename one of them".format(
+                    other.get_name(), device.get_name(), url_key
+                )
+            )
+        self.devices[url_key.encode()] = device
+        dbg("HTTP server: device registered on /%s/", url_key)
+
+    def route(self, request):
+        # path: /<key>/path
+        path = request.path
+        if path[:1] == b"/":
+            end = path.find(b"/", 1)
+            if end != -1:
+                device = self.devices.get(path[1:end])
+                if device:
+                    request.path = path[end:]
+                    return device
+        # requests without a known prefix are only unambiguous if there is
+        # a single device behind the listener
+        if len(self.devices) == 1:
+            for device in self.devices.values():
+                return device
+        return None
+
+    def handle_request(self, request, sender, socket):
+        device = self.route(request)
+        if device:
+            device.handle_request(request, sender, socket)
+        else:
+            ERRORS.inc()
+            dbg("No device for request: %s %s", request.method, request.path)
+            socket.send_error(b"404 Not Found")
 
 
 class upnp_device:
@@ -227,6 +990,8 @@ class upnp_device:
      Base class for a generic UPnP device. This is far from complete
      but it supports either specified or automatic IP address and port
      selection.
+     If an http_server is given, the device does not open a socket of its
+     own but is published on the shared server under /<url_key>/.
     """
 
     this_host_ip = None
@@ -235,11 +1000,10 @@ class upnp_device:
     def local_ip_address():
         if not upnp_device.this_host_ip:
             try:
-                ap_if = network.WLAN()
-                upnp_device.this_host_ip = ap_if.ifconfig()[0]
+                upnp_device.this_host_ip = hal.local_ip_address()
             except:
                 upnp_device.this_host_ip = "127.0.0.1"
-            dbg("got local address of %s" % upnp_device.this_host_ip)
+            dbg("got local address of %s", upnp_device.this_host_ip)
         return upnp_device.this_host_ip
 
     def __init__(
@@ -252,6 +1016,9 @@ class upnp_device:
         persistent_uuid,
         other_headers=None,
         ip_address=None,
+        http_server=None,
+        url_key=None,
+        search_template=None,
     ):
         self.listener = listener
         self.poller = poller
@@ -259,7 +1026,7 @@ class upnp_device:
         self.root_url = root_url
         self.server_version = server_version
         self.persistent_uuid = persistent_uuid
-        self.uuid = machine.unique_id()
+        self.uuid = hal.unique_id()
         self.other_headers = other_headers
 
         if ip_address:
@@ -267,91 +1034,46 @@ class upnp_device:
         else:
             self.ip_address = upnp_device.local_ip_address()
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((self.ip_address, self.port))
-        self.socket.listen(5)
-        if self.port == 0:
-            self.port = self.socket.getsockname()[1]
-        self.poller.add(self)
-        self.client_sockets = {}
-        self.listener.add_device(self)
-
-    def fileno(self):
-        return self.socket.fileno()
-
-    def sockets(self):
-        return self.socket
-
-    def do_read(self, socket):
-        fileno = socket.fileno()
-        dbg("Fileno %s" % fileno + " socket fileno %s" % self.socket.fileno())
-
-        if fileno == self.socket.fileno():
-            try:
-                (client_socket, client_address) = self.socket.accept()
-                self.poller.add(self, client_socket)
-                self.client_sockets[client_socket.fileno()] = client_socket
-            except Exception as e:
-                dbg("################################## Socket busy! %s" % str(e))
+        if http_server:
+            self.url_base = "/" + url_key
+            self.server = http_server
+            self.server.add_device(self, url_key)
         else:
-            data, sender = self.client_sockets[fileno].recvfrom(4096)
-            if not data:
-                self.poller.remove(self, self.client_sockets[fileno])
-                self.client_sockets[fileno].close()
-
-            else:
-                dbg("send response to socket!: %s" % str(fileno))
-                self.handle_request(data, sender, self.client_sockets[fileno])
-            gc.collect()
-
-    def handle_request(self, data, sender, socket):
-        pass
-
-    def get_name(self):
-        return "unknown"
-
-    def respond_to_search(self, destination, search_target):
-        dbg("Responding to search for %s" % self.get_name())
-        date_str = format_timetuple_and_zone(clock.gmtime(), "GMT")
-        location_url = self.root_url % {
-            "ip_address": self.ip_address,
-            "port": self.port,
-        }
-        message = (
-            "HTTP/1.1 200 OK\r\n"
-            "CACHE-CONTROL: max-age=86400\r\n"
-            "DATE: %s\r\n"
-            "EXT:\r\n"
-            "LOCATION: %s\r\n"
-            'OPT: "http://schemas.upnp.org/upnp/1/0/"; ns=01\r\n'
-            "01-NLS: %s\r\n"
-            "SERVER: %s\r\n"
-            "ST: %s\r\n"
-            "USN: uuid:%s::%s\r\n"
-            "X-User-Agent: redsonic\r\n\r\n"
-            % (
-                date_str,
+            self.url_base = ""
+            self.server = http_listener(self.poller, self.ip_address, self.port, self)
+        self.port = self.server.port
+        if search_template is None:
+            location_url = self.root_url % {
+                "ip_address": self.ip_address,
+                "port": self.port,
+                "url_base": self.url_base,
+            }
+            search_template = ssdp_response.template(
                 location_url,
                 self.uuid,
                 self.server_version,
-                search_target,
                 self.persistent_uuid,
-                search_target,
+                self.other_headers,
             )
-        )
+        self.search_template = search_template
+        self.search_response = ssdp_response(search_template)
+        self.listener.add_device(self)
 
-        if self.other_headers:
-            for header in self.other_headers:
-                message += "%s\r\n" % header
-        message += "\r\n"
+    def handle_request(self, request, sender, socket):
+        socket.send_error(b"404 Not Found")
 
-        try:
-            temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            temp_socket.sendto(message, destination)
-            temp_socket.close()
-            gc.collect()
-        except Exception as e:
-            dbg("Got problem to send response %s" % str(e))
+    def get_name(self):
+        return "unknown"
+
+    def respond_to_search(self, destination, search_target):
+        dbg("Responding to search for %s", self.get_name())
+        response = self.search_response.render(date_header.get(), search_target)
+        start = ticks_us()
+        if self.listener.sendto(response, destination):
+            SSDP_RESPONSES.inc()
+        else:
+            ERRORS.inc()
+        SSDP_SEND_TIME.since(start)
 
 
 class fauxmo(upnp_device):
@@ -359,6 +1081,11 @@ class fauxmo(upnp_device):
      This subclass does the bulk of the work to mimic a WeMo switch on the network.
     """
 
+    SETUP_URL = "http://%(ip_address)s:%(port)s%(url_base)s/setup.xml"
+    SERVER_VERSION = "Unspecified, UPnP/1.0, Unspecified"
+    UUID_PREFIX = "Socket-1_0-"
+    OTHER_HEADERS = ["X-User-Agent: redsonic"]
+
     @staticmethod
     def make_uuid(name):
         return "".join(
@@ -366,127 +1093,152 @@ class fauxmo(upnp_device):
             + ["%x" % ord(c) for c in "%sfauxmo!" % name]
         )[:14]
 
-    def __init__(self, name, listener, poller, ip_address, port, action_handler=None):
-        self.serial = self.make_uuid(name)
+    def __init__(
+        self,
+        name,
+        listener,
+        poller,
+        ip_address,
+        port,
+        action_handler=None,
+        http_server=None,
+        cached=None,
+    ):
+        # cached: strings of precomputed() of an earlier start
+        if cached:
+            self.serial = cached["serial"]
+        else:
+            self.serial = self.make_uuid(name)
         self.name = name
         self.ip_address = ip_address
         self.relayState = 0
-        persistent_uuid = "Socket-1_0-" + self.serial
-        other_headers = ["X-User-Agent: redsonic"]
+        persistent_uuid = self.UUID_PREFIX + self.serial
         upnp_device.__init__(
             self,
             listener,
             poller,
             port,
-            "http://%(ip_address)s:%(port)s/setup.xml",
-            "Unspecified, UPnP/1.0, Unspecified",
+            self.SETUP_URL,
+            self.SERVER_VERSION,
             persistent_uuid,
-            other_headers=other_headers,
+            other_headers=self.OTHER_HEADERS,
             ip_address=ip_address,
+            http_server=http_server,
+            url_key=self.serial,
+            search_template=cached["ssdp"] if cached else None,
         )
         if action_handler:
             self.action_handler = action_handler
         else:
             self.action_handler = self
+        if cached:
+            self.setup_xml = cached["setup_xml"]
+        else:
+            self.setup_xml = SETUP_XML % {
+                "device_name": self.name,
+                "device_serial": self.serial,
+                "url_base": self.url_base,
+            }
+        self.setup_response = cached_response("text/xml", XML_HEADERS, self.setup_xml)
         dbg(
-            "FauxMo device '%s' ready on %s:%s"
-            % (self.name, self.ip_address, self.port)
+            "FauxMo device '%s' ready on %s:%s%s"
+            % (self.name, self.ip_address, self.port, self.url_base)
         )
 
     def get_name(self):
         return self.name
 
-    def handle_request(self, data, sender, socket):
-        if (
-            data.find(b"POST /upnp/control/basicevent1 HTTP/1.1") == 0
-            and data.find(b"urn:Belkin:service:basicevent:1#GetBinaryState") != -1
-        ):
-            state = self.getState()
-            soap = GetBinaryState_soap % {"state_realy": state}
-            date_str = format_timetuple_and_zone(clock.gmtime(), "GMT")
-            message = (
-                "HTTP/1.1 200 OK\r\n"
-                "CONTENT-LENGTH: %d\r\n"
-                'CONTENT-TYPE: text/xml charset="utf-8"\r\n'
-                "DATE: %s\r\n"
-                "EXT:\r\n"
-                "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                "X-User-Agent: redsonic\r\n"
-                "CONNECTION: close\r\n"
-                "\r\n"
-                "%s" % (len(soap), date_str, soap)
-            )
-            socket.send(message)
-        elif data.find(b"GET /eventservice.xml HTTP/1.1") == 0:
-            dbg("Responding to eventservice.xml for %s" % self.name)
-            date_str = format_timetuple_and_zone(clock.gmtime(), "GMT")
-            message = (
-                "HTTP/1.1 200 OK\r\n"
-                "CONTENT-LENGTH: %d\r\n"
-                "CONTENT-TYPE: text/xml\r\n"
-                "DATE: %s\r\n"
-                "LAST-MODIFIED: Sat, 01 Jan 2000 00:01:15 GMT\r\n"
-                "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                "X-User-Agent: redsonic\r\n"
-                "CONNECTION: close\r\n"
-                "\r\n"
-                "%s" % (len(eventservice_xml), date_str, eventservice_xml)
-            )
-            socket.send(message)
-        elif data.find(b"GET /setup.xml HTTP/1.1") == 0:
-            dbg("Responding to setup.xml for %s" % self.name)
-            xml = SETUP_XML % {"device_name": self.name, "device_serial": self.serial}
-            date_str = format_timetuple_and_zone(clock.gmtime(), "GMT")
-            message = (
-                "HTTP/1.1 200 OK\r\n"
-                "CONTENT-LENGTH: %d\r\n"
-                "CONTENT-TYPE: text/xml\r\n"
-                "DATE: %s\r\n"
-                "LAST-MODIFIED: Sat, 01 Jan 2000 00:01:15 GMT\r\n"
-                "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                "X-User-Agent: redsonic\r\n"
-                "CONNECTION: close\r\n"
-                "\r\n"
-                "%s" % (len(xml), date_str, xml)
+    def precomputed(self):
+        # strings which do not change as long as config, address and port
+        # stay the same
+        return {
+            "serial": self.serial,
+            "setup_xml": self.setup_xml,
+            "ssdp": self.search_template,
+        }
+
+    def handle_request(self, request, sender, socket):
+        action = request.headers.get(b"soapaction")
+        if action is not None:
+            action = action.strip(b'"')
+        handler = self.DISPATCH.get((request.method, request.path, action))
+        if handler:
+            handler(self, request, socket)
+        else:
+            dbg("Unknown request %s %s", request.method, request.path)
+            socket.send_error(b"404 Not Found")
+
+    def get_binary_state(self, request, socket):
+        date = date_header.get()
+        self.reply(
+            socket,
+            BINARYSTATE_RESPONSE.render(date, self.getState(), socket.keep_alive),
+        )
+
+    def set_binary_state(self, request, socket):
+        # the handler runs on the actuator, the response only waits for the
+        # new state to be recorded
+        success = False
+        body = request.body
+        start = body.find(b"<BinaryState>")
+        state = body[start + 13 : start + 14] if start != -1 else b""
+        if state == b"1":
+            # on
+            dbg("Responding to ON for %s", self.name)
+            self.relayState = 1
+            success = actuator.submit(self, 1)
+        elif state == b"0":
+            # off
+            dbg("Responding to OFF for %s", self.name)
+            self.relayState = 0
+            success = actuator.submit(self, 0)
+        else:
+            dbg("Unknown Binary State request:")
+            socket.send_error(b"400 Bad Request")
+            return
+
+        if success:
+            self.save_state()
+            date = date_header.get()
+            self.reply(
+                socket,
+                BINARYSTATE_RESPONSE.render(date, self.getState(), socket.keep_alive),
             )
-            socket.send(message)
-        elif (
-            data.find(b'SOAPACTION: "urn:Belkin:service:basicevent:1#SetBinaryState"')
-            != -1
-        ):
-            success = False
-            if data.find(b"<BinaryState>1</BinaryState>") != -1:
-                # on
-                dbg("Responding to ON for %s" % self.name)
-                self.relayState = 1
-                success = self.action_handler.on()
-            elif data.find(b"<BinaryState>0</BinaryState>") != -1:
-                # off
-                dbg("Responding to OFF for %s" % self.name)
-                self.relayState = 0
-                success = self.action_handler.off()
-            else:
-                dbg("Unknown Binary State request:")
-
-            if success:
-                state = self.getState()
-                soap = GetBinaryState_soap % {"state_realy": state}
-                date_str = format_timetuple_and_zone(clock.gmtime(), "GMT")
-                message = (
-                    "HTTP/1.1 200 OK\r\n"
-                    "CONTENT-LENGTH: %d\r\n"
-                    'CONTENT-TYPE: text/xml charset="utf-8"\r\n'
-                    "DATE: %s\r\n"
-                    "EXT:\r\n"
-                    "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                    "X-User-Agent: redsonic\r\n"
-                    "CONNECTION: close\r\n"
-                    "\r\n"
-                    "%s" % (len(soap), date_str, soap)
-                )
-                socket.send(message)
         else:
-            dbg(data)
+            ERRORS.inc()
+            socket.send_error(b"500 Internal Server Error")
+
+    def eventservice(self, request, socket):
+        dbg("Responding to eventservice.xml for %s", self.name)
+        date = date_header.get()
+        self.reply(socket, EVENTSERVICE_RESPONSE.render(date, None, socket.keep_alive))
+
+    def setup(self, request, socket):
+        dbg("Responding to setup.xml for %s", self.name)
+        date = date_header.get()
+        self.reply(socket, self.setup_response.render(date, None, socket.keep_alive))
+
+    # (method, path, SOAP action) -> handler of the request
+    DISPATCH = {
+        (
+            b"POST",
+            b"/upnp/control/basicevent1",
+            b"urn:Belkin:service:basicevent:1#GetBinaryState",
+        ): get_binary_state,
+        (
+            b"POST",
+            b"/upnp/control/basicevent1",
+            b"urn:Belkin:service:basicevent:1#SetBinaryState",
+        ): set_binary_state,
+        (b"GET", b"/eventservice.xml", None): eventservice,
+        (b"GET", b"/setup.xml", None): setup,
+    }
+
+    def reply(self, socket, response):
+        start = ticks_us()
+        socket.send(response)
+        SEND_TIME.since(start)
+        HTTP_RESPONSES.inc()
 
     def on(self):
         return False
@@ -497,6 +1249,99 @@ class fauxmo(upnp_device):
     def getState(self):
         return self.relayState
 
+    def save_state(self):
+        # the snapshot is written later by device_states.flush()
+        state = {"state": self.relayState}
+        if hasattr(self.action_handler, "save"):
+            state.update(self.action_handler.save())
+        device_states.record(self.name, state)
+
+
+class ssdp_scheduler:
+    """
+     Deadline queue for SSDP search responses. Each reply is delayed by a
+     random time inside the MX window of the search (as UPnP asks for) and
+     sent from the main loop once it is due, so a discovery burst never
+     blocks the handling of other requests.
+    """
+
+    def __init__(self):
+        # [deadline, device, destination, search_target], sorted by deadline
+        self.queue = []
+        # set by the asyncio engine to wake up its scheduler task
+        self.event = None
+
+    def schedule(self, delay_ms, device, destination, search_target):
+        now = ticks_ms()
+        entry = [ticks_add(now, delay_ms), device, destination, search_target]
+        i = len(self.queue)
+        while i > 0 and ticks_diff(self.queue[i - 1][0], entry[0]) > 0:
+            i -= 1
+        self.queue.insert(i, entry)
+        if self.event:
+            self.event.set()
+
+    def run(self):
+        """
+         Sends the replies that are due. Returns the time in ms until the next
+         reply is due or None if nothing is queued.
+        """
+        while self.queue:
+            wait = ticks_diff(self.queue[0][0], ticks_ms())
+            if wait > 0:
+                return wait
+            deadline, device, destination, search_target = self.queue.pop(0)
+            device.respond_to_search(destination, search_target)
+        return None
+
+
+class search_filter:
+    """
+     Decides which M-SEARCH requests are answered. A search is suppressed if
+     the same sender asked for the same search target within window_ms; the
+     answered searches are kept in a table of at most max_entries. The
+     replies are limited by a token bucket (rate per second, at most burst
+     at once), so a flood of searches cannot turn the device into a reply
+     amplifier.
+    """
+
+    def __init__(self, window_ms, rate, burst, max_entries=16):
+        self.window_ms = window_ms
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        # (sender, search target) -> ticks of the answered search
+        self.recent = {}
+        self.tokens = burst
+        self.updated = ticks_ms()
+
+    def allow(self, sender, search_target, replies):
+        now = ticks_ms()
+        key = (sender, search_target)
+        answered = self.recent.get(key)
+        if answered is not None and ticks_diff(now, answered) < self.window_ms:
+            MSEARCH_SUPPRESSED.inc()
+            return False
+        elapsed = ticks_diff(now, self.updated)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate / 1000)
+        self.updated = now
+        if self.tokens < replies:
+            MSEARCH_LIMITED.inc()
+            return False
+        self.tokens -= replies
+        if answered is None and len(self.recent) >= self.max_entries:
+            self.expire(now)
+        self.recent[key] = now
+        return True
+
+    def expire(self, now):
+        recent = self.recent
+        for key in [k for k in recent if ticks_diff(now, recent[k]) >= self.window_ms]:
+            del recent[key]
+        if len(recent) >= self.max_entries:
+            # the table is full of active senders, forget the oldest
+            del recent[min(recent, key=lambda k: ticks_diff(recent[k], now))]
+
 
 class upnp_broadcast_responder:
     """
@@ -510,10 +1355,20 @@ class upnp_broadcast_responder:
     """
 
     TIMEOUT = 0
-    inprogress = False
+    # search targets answered (the Echo searches for the Belkin devices)
+    SEARCH_TARGETS = (b"urn:Belkin:device:**", b"upnp:rootdevice", b"ssdp:all")
+    # bounds of the MX (maximum wait in s) value of an M-SEARCH
+    MX_MIN = 1
+    MX_MAX = 5
 
     def __init__(self):
         self.devices = []
+        self.scheduler = ssdp_scheduler()
+        self.filter = search_filter(
+            SSDP_DEDUP_WINDOW_MS, SSDP_REPLY_RATE, SSDP_REPLY_BURST
+        )
+        # socket the search replies of all devices are sent from
+        self.sender = None
 
     def init_socket(self):
         ok = True
@@ -528,7 +1383,7 @@ class upnp_broadcast_responder:
             try:
                 self.ssock.bind(("", self.port))
             except Exception as e:
-                dbg("WARNING: Failed to bind %s:%d: %s", (self.ip, self.port, e))
+                dbg("WARNING: Failed to bind %s:%d: %s", self.ip, self.port, e)
                 ok = False
             try:
                 dbg(
@@ -562,22 +1417,37 @@ class upnp_broadcast_responder:
         data, sender = self.recvfrom(1024)
         if data:
             # Issue https://github.com/kakopappa/arduino-esp8266-alexa-multiple-wemo-switch/issues/22
-            if data.find(b"M-SEARCH") == 0 and self.inprogress is False:
-                if (
-                    data.find(b"upnp:rootdevice") != -1
-                    or data.find(b"ssdp:all") != -1
-                    or data.find(b"urn:Belkin:device:**") != -1
-                ):
-                    for device in self.devices:
-                        time.sleep(0.5)
-                        device.respond_to_search(
-                            sender, "urn:Belkin:device:**"
-                        )  # (sender, 'upnp:rootdevice')?
-                        self.inprogress = True
-                else:
-                    pass
+            if data.find(b"M-SEARCH") != 0:
+                return
+            MSEARCH_COUNT.inc()
+            for search_target in self.SEARCH_TARGETS:
+                if data.find(search_target) != -1:
+                    break
             else:
-                pass
+                return
+            if not self.filter.allow(sender, search_target, len(self.devices)):
+                return
+            window = self.mx(data) * 1000
+            for device in self.devices:
+                self.scheduler.schedule(
+                    random.getrandbits(16) % window,
+                    device,
+                    sender,
+                    "urn:Belkin:device:**",
+                )  # (sender, 'upnp:rootdevice')?
+
+    def mx(self, data):
+        start = data.find(b"\r\nMX:")
+        if start == -1:
+            start = data.find(b"\r\nmx:")
+        if start == -1:
+            return self.MX_MIN
+        end = data.find(b"\r\n", start + 5)
+        try:
+            mx = int(data[start + 5 : end])
+        except:
+            return self.MX_MIN
+        return min(max(mx, self.MX_MIN), self.MX_MAX)
 
     # Receive network data
     def recvfrom(self, size):
@@ -597,11 +1467,135 @@ class upnp_broadcast_responder:
             dbg(e)
             return False, False
 
+    def sendto(self, data, destination):
+        # returns False if the reply could not be sent
+        try:
+            if self.sender is None:
+                self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sender.sendto(data, destination)
+            return True
+        except Exception as e:
+            dbg("Got problem to send response %s", e)
+            # open a new socket for the next reply
+            if self.sender is not None:
+                self.sender.close()
+                self.sender = None
+            return False
+
     def add_device(self, device):
         self.devices.append(device)
         dbg("UPnP broadcast listener: new device registered")
 
 
+class actuation_queue:
+    """
+     Runs the on()/off() calls of the action handlers away from the request
+     path, on a thread pool (CPython), a _thread worker or, without threads,
+     from the main loop. Commands are coalesced per device: if a device is
+     switched again before its handler ran, only the last state is applied.
+     Until start() is called, submit() calls the handler right away.
+    """
+
+    def __init__(self):
+        self.pending = {}  # device -> state to apply
+        self.active = {}  # devices with a drain job queued or running
+        self.jobs = []
+        self.mode = "inline"
+        # set by the asyncio engine to wake up its actuation task
+        self.event = None
+        if thread_available:
+            self.lock = _thread.allocate_lock()
+        else:
+            self.lock = null_lock()
+
+    def start(self, workers=ACTUATION_WORKERS):
+        try:
+            # imported here, MicroPython has no thread pool
+            from concurrent.futures import ThreadPoolExecutor
+        except:
+            ThreadPoolExecutor = None
+        if ThreadPoolExecutor:
+            self.executor = ThreadPoolExecutor(workers)
+            self.mode = "pool"
+        elif thread_available:
+            self.wakeup = _thread.allocate_lock()
+            self.wakeup.acquire()
+            _thread.start_new_thread(self.worker, ())
+            self.mode = "thread"
+        else:
+            self.mode = "loop"
+
+    def submit(self, device, state):
+        """
+         Queues switching device to state. Returns True, a failing handler
+         is reported and reverts the state of the device.
+        """
+        if self.mode == "inline":
+            return self.apply(device, state)
+        self.lock.acquire()
+        self.pending[device] = state
+        new_job = device not in self.active
+        if new_job:
+            self.active[device] = True
+            if self.mode != "pool":
+                self.jobs.append(device)
+        self.lock.release()
+        if new_job:
+            if self.mode == "pool":
+                self.executor.submit(self.drain, device)
+            elif self.mode == "thread":
+                if self.wakeup.locked():
+                    self.wakeup.release()
+            elif self.event:
+                self.event.set()
+        return True
+
+    def drain(self, device):
+        while True:
+            self.lock.acquire()
+            state = self.pending.pop(device, None)
+            if state is None:
+                del self.active[device]
+            self.lock.release()
+            if state is None:
+                return
+            self.apply(device, state)
+
+    def run_jobs(self):
+        while self.jobs:
+            self.lock.acquire()
+            device = self.jobs.pop(0)
+            self.lock.release()
+            self.drain(device)
+
+    def worker(self):
+        while True:
+            self.wakeup.acquire()
+            self.run_jobs()
+
+    def apply(self, device, state):
+        start = ticks_us()
+        try:
+            if state:
+                success = device.action_handler.on()
+            else:
+                success = device.action_handler.off()
+        except Exception as e:
+            dbg("Handler of %s failed: %s", device.get_name(), e)
+            success = False
+        ACTUATE_TIME.since(start)
+        if not success:
+            ERRORS.inc()
+            dbg("Could not switch %s to %s", device.get_name(), state)
+            if device.relayState == state:
+                device.relayState = 1 - state
+                device.save_state()
+        return success
+
+
+actuator = actuation_queue()
+
+
 class rest_api_handler(object):
     """
      This is an example handler class. The fauxmo class expects handlers to be
@@ -609,33 +1603,86 @@ class rest_api_handler(object):
      on success and False otherwise.
 
      This example class takes a color and brightness.
-     It returns always True and ignores any return data.
+     The strip fades to the new color in the background (transition_ms,
+     default TRANSITION_MS), so the response is not delayed by it. The
+     transition is handed to the renderer, on() and off() only return False
+     if its queue is full.
+     leds limits the handler to the LEDs start..end-1 given as (start, end),
+     by default it controls the whole strip. The range is a segment of the
+     compositor, handlers switched within one tick share a strip update.
     """
 
-    def __init__(self, on_color, on_brightness):
-        global ledNumber
-        global ws2812_chain
+    def __init__(self, on_color, on_brightness, transition_ms=None, leds=None):
         self.on_color = on_color
         self.on_brightnessr = on_brightness
-        ws2812_chain.set_brightness(on_brightness)
+        # brightness of this device only, the strip is shared by all devices
+        self.table = brightness_table(on_brightness, GAMMA_CORRECTION)
+        if transition_ms is None:
+            transition_ms = TRANSITION_MS
+        self.transition_ms = transition_ms
+        if leds is None:
+            leds = (0, None)
+        self.leds = leds
+
+    def save(self):
+        # recorded with the state, but not restored: color and brightness
+        # are taken from config.json, so edits of it are not hidden
+        return {"color": list(self.on_color), "brightness": self.on_brightnessr}
+
+    def effect(self, state):
+        # transition of the LEDs of this handler to state, its segment was
+        # created by add_segments()
+        color = self.on_color if state else (0, 0, 0)
+        return fade(color, self.transition_ms, self.table, self.leds[0], self.leds[1])
 
     def on(self):
-        global ledNumber
-        global ws2812_chain
+        global effects
         # global_epoch = timeutils.epoch() # updating time using ntp
-        data = [self.on_color for i in range(ledNumber)]
-        ws2812_chain.show(data)
         dbg("response on")
-        return True
+        # False if the queue of the renderer is full
+        return effects.start(self.effect(1))
 
     def off(self):
-        global ledNumber
-        global ws2812_chain
+        global effects
         # global_epoch = timeutils.epoch() # updating time using ntp
-        data = [(0, 0, 0) for i in range(ledNumber)]
-        ws2812_chain.show(data)
         dbg("response off")
-        return True
+        return effects.start(self.effect(0))
+
+
+class group_handler(object):
+    """
+     Handler of a group (scene) device, which switches several handlers at
+     once. The transitions of all members driving the LED strip (members
+     with an effect() method) are started together and reach the strip in
+     one frame. Other members are switched by their on()/off() methods.
+     Returns True if all members succeeded.
+    """
+
+    def __init__(self, members):
+        self.members = members
+
+    def switch(self, state):
+        global effects
+        batch = []
+        success = True
+        for member in self.members:
+            if hasattr(member, "effect"):
+                batch.append(member.effect(state))
+            elif state:
+                success = member.on() and success
+            else:
+                success = member.off() and success
+        if batch:
+            success = effects.start_all(batch) and success
+        return success
+
+    def on(self):
+        dbg("group on")
+        return self.switch(1)
+
+    def off(self):
+        dbg("group off")
+        return self.switch(0)
 
 
 class InvalidPortException(Exception):
@@ -643,32 +1690,46 @@ class InvalidPortException(Exception):
     pass
 
 
-def thread_echo(args):
-    global DEBUG
-    global clock
-    global ws2812_chain
-    # Set up our singleton for polling the sockets for data ready
+class DuplicateDeviceException(Exception):
+    pass
 
-    ws2812_chain = WS2812(ledNumber=ledNumber, brightness=100)
-    p = poller()
 
+def make_handler(entry):
+    """
+     Handler of a device entry of config.json: a group_handler of the
+     entries in "group" or a rest_api_handler of "color", "brightness" and
+     the optional "transition_ms" and "leds" ([start, end], end may be null).
     """
-     Each entry is a list with the following elements:
+    if "group" in entry:
+        return group_handler([make_handler(member) for member in entry["group"]])
+    leds = entry.get("leds")
+    return rest_api_handler(
+        tuple(entry["color"]),
+        entry["brightness"],
+        entry.get("transition_ms"),
+        tuple(leds) if leds else None,
+    )
+
+
+def default_devices():
+    """
+     Devices used without config.json (the same devices can be declared
+     there, see devconfig.py). Each entry is a list with the following
+     elements:
 
      # name of the virtual switch
      # handler object with 'on' and 'off' methods (e.g. rest_api_handler((rrr, ggg, bbb), lux)})
+       or group_handler([handler, ...]) to switch several handlers at once
      # port #
 
      NOTE: As of 2015-08-17, the Echo appears to have a hard-coded limit of
-## ftp access
-#from ftp import ftpserver
-
      16 switches it can control. Only the first 16 elements of the 'devices'
      list will be used.
      NOTE: Micropython has a limitation in the number of opened sockets (8).
-     Then, the maximal device number is limited to 3.
+     With SHARED_HTTP_PORT all devices share one listening socket, so the
+     16 switches fit. Without it the maximal device number is limited to 3.
     """
-    devices = [
+    return [
         {
             "description": "white led",
             "port": 12340,
@@ -694,8 +1755,135 @@ def thread_echo(args):
             "port": 12344,
             "handler": rest_api_handler((255, 165, 0), 90),
         },
+        {
+            # group: both halves of the strip in one command
+            "description": "two tone led",
+            "port": 12345,
+            "handler": group_handler(
+                [
+                    rest_api_handler((255, 0, 0), 50, leds=(0, ledNumber // 2)),
+                    rest_api_handler((30, 144, 255), 90, leds=(ledNumber // 2, None)),
+                ]
+            ),
+        },
     ]
 
+
+def add_segments(handler):
+    # creates the compositor segments of a handler and its group members
+    if hasattr(handler, "members"):
+        for member in handler.members:
+            add_segments(member)
+    elif hasattr(handler, "leds"):
+        compositor.segment(handler.leds[0], handler.leds[1])
+
+
+def start_devices():
+    """
+     Starts the LED strip and creates the handlers of the devices with their
+     last state, which needs no network. Returns the config and the devices.
+    """
+    global ws2812_chain
+    global strip
+    global compositor
+    global effects
+
+    # brightness is applied by the renderer
+    ws2812_chain = hal.WS2812(ledNumber=ledNumber, brightness=100)
+    strip = strip_renderer(ws2812_chain, ledNumber, gamma=GAMMA_CORRECTION)
+    compositor = strip_compositor(strip)
+    effects = effects_engine(compositor)
+    actuator.start()
+
+    # devices of config.json, the ones of default_devices() without it
+    config = device_config(CONFIG_FILE)
+    if config.load() and config.devices:
+        devices = [
+            {
+                "description": entry["description"],
+                "port": entry.get("port", 0),
+                "handler": make_handler(entry),
+            }
+            for entry in config.devices
+        ]
+    else:
+        devices = default_devices()
+    for device in devices:
+        add_segments(device["handler"])
+    # the segments are complete before the render thread iterates them
+    if EFFECTS_THREAD and thread_available:
+        effects.start_thread()
+
+    # restore the last state before the sockets are opened, so the LEDs
+    # are back right after power-on. The devices are switched in the order
+    # they were switched before, devices sharing LEDs leave the same picture.
+    if device_states.load():
+        handlers = {}
+        for device in devices:
+            handlers[device["description"]] = device["handler"]
+        for name in device_states.ordered():
+            handler = handlers.get(name)
+            if handler is None:
+                continue
+            if device_states.get(name).get("state"):
+                handler.on()
+            else:
+                handler.off()
+    return config, devices
+
+
+def start_wlan(config):
+    # boot.py has already started an attempt with the credentials of
+    # config.json or its SSID/WPA2_PASS. On the board boot.py and main.py
+    # share their globals, so the same credentials are used for the retries.
+    ssid = globals().get("ssid_")
+    if ssid:
+        password = globals().get("wpa2_pass")
+    else:
+        ssid = config.wlan.get("ssid")
+        password = config.wlan.get("password")
+    return wlan_connector(hal.station(), ssid, password)
+
+
+def set_clock(synced):
+    global clock
+    clock = synced
+    # the cached DATE is formatted again with the synced clock
+    date_header.second = None
+    dbg("Clock synced")
+
+
+def start_clock():
+    # NTP sync in the background, DATE does not wait for it
+    sync = clock_sync(hal.ntp_clock, NTP_SERVER, set_clock)
+    sync.start()
+    return sync
+
+
+def cache_version():
+    """
+     Part of the key of the config cache which changes with the templates
+     of the precomputed strings (a firmware update) and the board, whose
+     unique id is the NLS of the SSDP replies.
+    """
+    templates = SETUP_XML + fauxmo.make_uuid("uPyEcho")
+    templates += ssdp_response.template(
+        fauxmo.SETUP_URL,
+        "",
+        fauxmo.SERVER_VERSION,
+        fauxmo.UUID_PREFIX,
+        fauxmo.OTHER_HEADERS,
+    )
+    return "%08x:%s" % (
+        crc32(templates.encode()) & 0xFFFFFFFF,
+        hexlify(hal.unique_id()).decode(),
+    )
+
+
+def start_services(p, config=None, devices=None):
+    if devices is None:
+        config, devices = start_devices()
+
     # Set up our singleton listener for UPnP broadcasts
     u = upnp_broadcast_responder()
     u.init_socket()
@@ -703,6 +1891,19 @@ def thread_echo(args):
     # when a broadcast is received.
     p.add(u)
 
+    # Set up the HTTP listener shared by all devices
+    if SHARED_HTTP_PORT is not None:
+        http_server = upnp_http_server(p, SHARED_HTTP_PORT)
+    else:
+        http_server = None
+
+    # precomputed strings of the devices of config.json
+    cache_key = config.cache_key(
+        upnp_device.local_ip_address(), SHARED_HTTP_PORT, cache_version()
+    )
+    cached = config.devices and config.load_cache(cache_key)
+    precomputed = {}
+
     # Create our FauxMo virtual switch devices
     # Initialize FauxMo devices
     for device in devices:
@@ -716,41 +1917,143 @@ def thread_echo(args):
                     type(device["port"]), device["port"]
                 )
             )
-        fauxmo(
+        switch = fauxmo(
             device["description"],
             u,
             p,
             None,
             device["port"],
             action_handler=device["handler"],
+            http_server=http_server,
+            # a device with a port of its own keeps its cached location only
+            # if the port is fixed
+            cached=config.cache.get(device["description"])
+            if http_server or device["port"]
+            else None,
         )
+        precomputed[switch.name] = switch.precomputed()
+        saved = device_states.get(switch.name)
+        if saved:
+            switch.relayState = saved.get("state", 0)
+
+    if config.devices and not cached:
+        config.save_cache(cache_key, precomputed)
 
-    # setting the clock using ntp
-    if uname().machine == "WiPy with ESP32":
-        # Wipy 2.0
-        clock_tmp = RTC()
-        clock_tmp.ntp_sync("time1.google.com")
-        clock = time  # gmtime function needed
-    elif uname().machine == "ESP32 module with ESP32":
-        # Wemos ESP-WROOM-32
-        clock = RTC()  # gmtime function needed
-        clock.ntp_sync("time1.google.com")
+    return u
+
+
+async def async_ssdp(scheduler):
+    scheduler.event = asyncio.Event()
+    while True:
+        wait = scheduler.run()
+        if wait is None:
+            await scheduler.event.wait()
+            scheduler.event.clear()
+        else:
+            await asyncio.sleep(wait / 1000)
+
+
+async def async_effects(effects):
+    effects.event = asyncio.Event()
+    while True:
+        if effects.tick():
+            await asyncio.sleep(effects.tick_ms / 1000)
+        else:
+            await effects.event.wait()
+            effects.event.clear()
+
+
+async def async_actuation(actuator):
+    actuator.event = asyncio.Event()
+    while True:
+        await actuator.event.wait()
+        actuator.event.clear()
+        actuator.run_jobs()
+
+
+async def async_echo():
+    config, devices = start_devices()
+    wlan = start_wlan(config)
+    ip_address = wlan.poll()
+    while ip_address is None:
+        await asyncio.sleep(wlan.check_ms / 1000)
+        ip_address = wlan.poll()
+    upnp_device.this_host_ip = ip_address
+    dbg("Connected as %s", ip_address)
+
+    # the poller has to be created inside the running event loop
+    p = async_poller()
+    u = start_services(p, config, devices)
+    ntp = start_clock()
+    asyncio.create_task(async_ssdp(u.scheduler))
+    if not effects.threaded:
+        asyncio.create_task(async_effects(effects))
+    if actuator.mode == "loop":
+        asyncio.create_task(async_actuation(actuator))
+
+    dbg("Entering asyncio event loop\n")
+    while True:
+        # the sockets are served by their own tasks, here is only housekeeping
+        await asyncio.sleep(1)
+        try:
+            client_connections.expire()
+            device_states.flush()
+            ntp.step()
+            collector.idle()
+        except Exception as e:
+            ERRORS.inc()
+            dbg(e)
+
+
+def thread_echo(args):
+    if ENGINE == "asyncio" and import_asyncio():
+        asyncio.run(async_echo())
+        return
+
+    # the LEDs are back before the network is
+    config, devices = start_devices()
+    wlan = start_wlan(config)
+    ip_address = wlan.poll()
+    while ip_address is None:
+        time.sleep(wlan.check_ms / 1000)
+        ip_address = wlan.poll()
+    upnp_device.this_host_ip = ip_address
+    dbg("Connected as %s", ip_address)
+
+    # Set up our singleton for polling the sockets for data ready
+    p = poller()
+    u = start_services(p, config, devices)
+    ntp = start_clock()
 
     dbg("Entering main loop\n")
     while True:
         try:
             # Allow time for a ctrl-c to stop the process
             p.poll(10)
-            time.sleep(0.1)
-            gc.collect()
+            u.scheduler.run()
+            actuator.run_jobs()
+            client_connections.expire()
+            device_states.flush()
+            ntp.step()
+            # the garbage of the requests is collected between events
+            collector.idle()
+            if effects.threaded or not effects.tick():
+                # nothing to animate
+                time.sleep(0.1)
         except Exception as e:
+            ERRORS.inc()
             dbg(e)
             # break
 
 
-if thread_available:
-    print("Starting echo serviceList on separated thread\n")
-    _thread.start_new_thread(thread_echo, ("",))
-else:
-    print("Starting echo services\n")
-    thread_echo("")
+if __name__ == "__main__":
+    if hal.hosted:
+        # Linux service: the services are the main thread
+        print("Starting echo services (hosted)\n")
+        thread_echo("")
+    elif thread_available:
+        print("Starting echo serviceList on separated thread\n")
+        _thread.start_new_thread(thread_echo, ("",))
+    else:
+        print("Starting echo services\n")
+        thread_echo("")
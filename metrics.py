@@ -0,0 +1,101 @@
+"""
+Lightweight instrumentation of the hot paths.
+
+Counters, gauges and timings use fixed memory: a timing keeps the count
+and sum of all its samples and the last SAMPLES durations (us) in a ring
+buffer, from which the quantiles are computed only when the metrics are
+read.
+render() returns all registered metrics in the Prometheus text format,
+main.py serves them on /metrics.
+"""
+from array import array
+
+from hal import ticks_us, ticks_diff
+
+SAMPLES = 64  # durations kept per timing
+QUANTILES = (0.5, 0.9, 0.99)
+
+# all counters and timings in the order they are rendered
+registry = []
+
+
+class counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        registry.append(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self, out):
+        out.append(
+            "# HELP %s %s\n# TYPE %s counter\n%s %d\n"
+            % (self.name, self.help, self.name, self.name, self.value)
+        )
+
+
+class gauge:
+    # value read from read() when the metrics are rendered
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+        registry.append(self)
+
+    def render(self, out):
+        out.append(
+            "# HELP %s %s\n# TYPE %s gauge\n%s %s\n"
+            % (self.name, self.help, self.name, self.name, self.read())
+        )
+
+
+class timing:
+    """
+     Durations of an operation, reported as a Prometheus summary in
+     seconds. The quantiles are those of the last `size` samples.
+    """
+
+    def __init__(self, name, help, size=SAMPLES):
+        self.name = name
+        self.help = help
+        self.ring = array("L", [0] * size)
+        self.index = 0
+        self.count = 0
+        self.total = 0  # us
+        registry.append(self)
+
+    def add(self, us):
+        self.ring[self.index] = us
+        self.index = (self.index + 1) % len(self.ring)
+        self.count += 1
+        self.total += us
+
+    def since(self, start):
+        # adds the time elapsed since start (ticks_us())
+        self.add(ticks_diff(ticks_us(), start))
+
+    def quantile(self, fraction):
+        samples = sorted(self.ring[: min(self.count, len(self.ring))])
+        if not samples:
+            return 0
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    def render(self, out):
+        name = self.name
+        out.append("# HELP %s %s\n# TYPE %s summary\n" % (name, self.help, name))
+        for fraction in QUANTILES:
+            out.append(
+                '%s{quantile="%s"} %.6f\n'
+                % (name, fraction, self.quantile(fraction) / 1000000)
+            )
+        out.append("%s_sum %.6f\n" % (name, self.total / 1000000))
+        out.append("%s_count %d\n" % (name, self.count))
+
+
+def render():
+    out = []
+    for metric in registry:
+        metric.render(out)
+    return "".join(out).encode()
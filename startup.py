@@ -0,0 +1,117 @@
+"""
+Non-blocking startup.
+
+wlan_connector brings the station interface up without busy-waiting: the
+main loop calls poll() every check_ms until it returns the IP address,
+a connection attempt which does not succeed within its timeout is
+repeated with a doubled timeout (backoff). clock_sync runs the NTP sync
+in the background and retries it until it succeeds; until then the DATE
+headers are taken from the time since boot.
+
+Both only need objects with the interface of network.WLAN and a sync
+function, so they can be driven by stand-ins on the host.
+"""
+import time
+
+from hal import _thread, thread_available, ticks_ms, ticks_diff
+
+
+class wlan_connector:
+    def __init__(
+        self,
+        wlan,
+        ssid=None,
+        password=None,
+        check_ms=100,
+        timeout_ms=10000,
+        max_timeout_ms=60000,
+    ):
+        self.wlan = wlan
+        self.ssid = ssid
+        self.password = password
+        self.check_ms = check_ms
+        self.timeout_ms = timeout_ms
+        self.max_timeout_ms = max_timeout_ms
+        # the attempt started by boot.py counts as the first one and gets
+        # the first timeout before it is repeated
+        self.attempts = 1
+        self.started = ticks_ms()
+        self.error = None  # exception of the last failed check
+
+    def poll(self):
+        """
+         Returns the IP address once connected, None while connecting.
+        """
+        try:
+            if self.wlan.isconnected():
+                return self.wlan.ifconfig()[0]
+        except OSError as e:
+            # e.g. no route yet, checked again on the next poll
+            self.error = e
+            return None
+        now = ticks_ms()
+        if ticks_diff(now, self.started) >= self.timeout_ms:
+            self.timeout_ms = min(2 * self.timeout_ms, self.max_timeout_ms)
+            self.connect(now)
+        return None
+
+    def connect(self, now):
+        self.attempts += 1
+        self.started = now
+        self.wlan.active(True)
+        if not self.ssid:
+            # without credentials only the attempt of boot.py is waited for
+            return
+        try:
+            self.wlan.connect(self.ssid, self.password)
+        except OSError:
+            # still busy with the previous attempt
+            pass
+
+
+class clock_sync:
+    """
+     Calls sync(server) until it returns a clock (an object with gmtime())
+     and hands it to on_synced(clock). sync may return None if there is
+     nothing to sync (unknown board). The sync runs on a thread of its own
+     if possible, otherwise step() has to be called from the main loop.
+    """
+
+    def __init__(self, sync, server, on_synced, retry_ms=30000):
+        self.sync = sync
+        self.server = server
+        self.on_synced = on_synced
+        self.retry_ms = retry_ms
+        self.done = False
+        self.threaded = False
+        self.last_try = None
+        self.error = None  # exception of the last failed attempt
+
+    def start(self):
+        if thread_available:
+            self.threaded = True
+            _thread.start_new_thread(self.run, ())
+
+    def attempt(self):
+        self.last_try = ticks_ms()
+        try:
+            clock = self.sync(self.server)
+        except Exception as e:
+            self.error = e
+            return False
+        self.done = True
+        if clock is not None:
+            self.on_synced(clock)
+        return True
+
+    def run(self):
+        while not self.attempt():
+            time.sleep(self.retry_ms / 1000)
+
+    def step(self):
+        if self.done or self.threaded:
+            return
+        if self.last_try is None or (
+            ticks_diff(ticks_ms(), self.last_try) >= self.retry_ms
+        ):
+            self.attempt()
@@ -0,0 +1,140 @@
+"""
+Persistent state of the virtual devices.
+
+The state of every device (relay state, color, brightness) is kept in
+memory and written to flash as one JSON snapshot. Changes are coalesced:
+flush() only writes once no change happened for debounce_ms (or the
+oldest unsaved change is max_delay_ms old), so a burst of voice commands
+costs a single write. The snapshot is written to a temporary file and
+renamed over the previous one, a power loss never leaves a half-written
+snapshot behind. A failed write (flash full, file system error) keeps the
+changes and is retried after a backoff which doubles up to max_retry_ms.
+Every change gets a sequence number ("seq"), so devices sharing LEDs can
+be restored in the order they were switched.
+"""
+try:
+    import ujson as json
+except:
+    import json
+try:
+    import uos as os
+except:
+    import os
+from hal import ticks_ms, ticks_diff
+
+
+class state_store:
+    def __init__(
+        self,
+        path,
+        debounce_ms=2000,
+        max_delay_ms=20000,
+        retry_ms=5000,
+        max_retry_ms=300000,
+        log=None,
+    ):
+        self.path = path
+        self.debounce_ms = debounce_ms
+        self.max_delay_ms = max_delay_ms
+        self.retry_ms = retry_ms
+        self.max_retry_ms = max_retry_ms
+        # log(msg, *args) of failed writes (optional)
+        self.log = log
+        self.states = {}  # device name -> dict of its state
+        self.sequence = 0  # "seq" of the last change
+        self.dirty = False
+        self.first_change = 0
+        self.last_change = 0
+        self.writes = 0
+        self.backoff_ms = 0  # wait after the last failed write
+        self.failed = 0
+        self.error = None  # exception of the last failed write
+
+    def load(self):
+        """
+         Reads the last snapshot. A left-over temporary file is used if the
+         snapshot itself is missing (power loss during the rename).
+        """
+        for path in (self.path, self.path + ".tmp"):
+            try:
+                with open(path) as snapshot:
+                    self.states = json.load(snapshot)
+                self.sequence = max(
+                    [state.get("seq", 0) for state in self.states.values()] + [0]
+                )
+                return True
+            except:
+                pass
+        return False
+
+    def get(self, name):
+        return self.states.get(name)
+
+    def ordered(self):
+        # names of the devices, the least recently changed first
+        names = list(self.states)
+        names.sort(key=lambda name: self.states[name].get("seq", 0))
+        return names
+
+    def record(self, name, state):
+        # a change which repeats the last one is not recorded again
+        state["seq"] = self.sequence
+        if self.states.get(name) == state:
+            return
+        self.sequence += 1
+        state["seq"] = self.sequence
+        self.states[name] = state
+        now = ticks_ms()
+        if not self.dirty:
+            self.dirty = True
+            self.first_change = now
+        self.last_change = now
+
+    def flush(self, force=False):
+        """
+         Writes the snapshot if it is due. Returns True if it was written.
+        """
+        if not self.dirty:
+            return False
+        now = ticks_ms()
+        if self.backoff_ms and not force:
+            if ticks_diff(now, self.failed) < self.backoff_ms:
+                return False
+        elif not (
+            force
+            or ticks_diff(now, self.last_change) >= self.debounce_ms
+            or ticks_diff(now, self.first_change) >= self.max_delay_ms
+        ):
+            return False
+        try:
+            self.write()
+        except OSError as e:
+            self.error = e
+            self.failed = now
+            self.backoff_ms = min(
+                2 * self.backoff_ms or self.retry_ms, self.max_retry_ms
+            )
+            if self.log:
+                self.log(
+                    "Saving %s failed: %s, retry in %d ms",
+                    self.path,
+                    e,
+                    self.backoff_ms,
+                )
+            return False
+        self.dirty = False
+        self.backoff_ms = 0
+        self.error = None
+        self.writes += 1
+        return True
+
+    def write(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as snapshot:
+            json.dump(self.states, snapshot)
+        try:
+            os.rename(temporary, self.path)
+        except OSError:
+            # FAT does not rename over an existing file
+            os.remove(self.path)
+            os.rename(temporary, self.path)